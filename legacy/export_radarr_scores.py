@@ -11,12 +11,37 @@ Requires:
     - Python 3.6+
     - `requests` library (install via pip: pip install requests)
     - Access to a Radarr v3+ instance with API key.
+
+Optional:
+    - `ijson` library (pip install ijson) to stream-parse the movie list,
+      keeping memory use low on large libraries.
+    - `orjson` library (pip install orjson) for faster decoding of API responses.
 """
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import csv
 import json
+import sqlite3
+import sys
+import threading
 import time
 import concurrent.futures # For parallel processing
+import hashlib
+import heapq
+from functools import partial
+from itertools import islice
+from operator import itemgetter
+
+try:
+    import ijson # Optional: streaming JSON parser for the movie list
+except ImportError:
+    ijson = None
+
+try:
+    import orjson # Optional: faster JSON decoding of API responses
+except ImportError:
+    orjson = None
 
 # --- Configuration ---
 # ┌─────────────────────────────┐
@@ -26,6 +51,16 @@ RADARR_API_KEY = "YOUR_APP_API_KEY_HERE"  # Replace with your actual Radarr API
 RADARR_URL     = "http://127.0.0.1:7878" # Replace with your Radarr URL (e.g., http://radarr:7878 or https://radarr.domain.com)
 RADARR_OUTPUT_CSV = "radarr_custom_scores.csv" # Name of the output CSV file
 
+# Only export the N highest-scoring movies (e.g., 100). Set to None to export all movies.
+RADARR_TOP_N = None
+
+# SQLite file used to cache movie file details between runs, so unchanged files
+# are not fetched again (e.g., "radarr_cache.db"). Set to None to disable the cache.
+# Entries are invalidated when a file's 'dateAdded' or 'size' changes, when a movie
+# moves to another quality profile, or when the custom format scores in any quality
+# profile change. Delete the cache file after editing custom format conditions.
+RADARR_CACHE_DB = None
+
 # ┌─────────────────────────────┐
 # │    PERFORMANCE & TIMING     │
 # └─────────────────────────────┘
@@ -38,17 +73,56 @@ MAX_WORKERS = 15
 # Seconds to wait for a response from the Radarr API for each request.
 API_TIMEOUT = 30
 
+# Number of movies whose file details are requested in a single API call.
+# Larger batches mean fewer requests but bigger responses.
+MOVIE_FILE_BATCH_SIZE = 100
+
 # Delay in seconds between consecutive API requests made by the main thread
 # or within the same worker thread (if applicable).
 # Useful for very slow servers or strict rate limiting. Keep at 0.0 for most cases.
 REQUEST_DELAY = 0.0
 
 # --- Constants ---
-# (No user-configurable constants currently)
+# Movie fields kept from the movie list; everything else (images, ratings,
+# alternate titles, ...) is discarded as soon as each movie is parsed.
+MOVIE_FIELDS = ("id", "title", "hasFile", "qualityProfileId")
+MOVIE_FILE_FIELDS = ("id", "relativePath", "dateAdded", "size")
+
+# CSV header columns; each processed row is a tuple in this order.
+RADARR_FIELDNAMES = ("Title", "File", "Score", "Quality Profile")
 
 # --- Helper Functions ---
 
-def make_api_request(base_url, api_key, endpoint, params=None, session=None):
+def create_session():
+    """
+    Creates a requests session with a connection pool sized for MAX_WORKERS.
+
+    The default HTTPAdapter only keeps 10 connections per host, so with more
+    worker threads than that, connections get discarded and re-opened instead
+    of being reused (keep-alive). The adapter also retries failed GETs.
+
+    Returns:
+        requests.Session: A session with a tuned HTTPAdapter mounted for http and https,
+                          asking for compressed, kept-alive responses.
+    """
+    session = requests.Session()
+    # Retry transient failures (e.g. a 502 while Radarr runs a backup) with exponential
+    # backoff instead of silently dropping the movie; 429s wait for Retry-After.
+    retry = Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Compressed JSON is 5-10x smaller; requests/urllib3 decompress it transparently
+    session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+    return session
+
+def make_api_request(base_url, api_key, endpoint, params=None, session=None, stream=False):
     """
     Makes an API request to the specified endpoint with error handling.
 
@@ -56,21 +130,37 @@ def make_api_request(base_url, api_key, endpoint, params=None, session=None):
         base_url (str): The base URL of the Radarr/Sonarr instance.
         api_key (str): The API key for authentication.
         endpoint (str): The API endpoint (e.g., '/api/v3/movie').
-        params (dict, optional): Query parameters for the request. Defaults to None.
+        params (dict or list, optional): Query parameters for the request. A list of
+            (key, value) tuples can be used to repeat a key. Defaults to None.
         session (requests.Session, optional): A requests session object to use. Defaults to None.
+        stream (bool, optional): Return the open response instead of the parsed JSON, so the
+            body can be parsed incrementally from `response.raw`. The caller must close it.
+            Defaults to False.
 
     Returns:
         dict or None: The JSON response as a dictionary if successful, None otherwise.
+                      With stream=True, the requests.Response object or None.
     """
     if params is None:
         params = {}
     headers = {"X-Api-Key": api_key} # Use header for API key - more standard
     url = f"{base_url.rstrip('/')}{endpoint}" # Ensure no double slashes
     requester = session or requests # Use provided session or default requests module
-    time.sleep(REQUEST_DELAY) # Apply delay before each request
+    if REQUEST_DELAY: # Skip the sleep syscall entirely when no delay is configured
+        time.sleep(REQUEST_DELAY)
     try:
-        r = requester.get(url, params=params, headers=headers, timeout=API_TIMEOUT)
-        r.raise_for_status() # Raises HTTPError for 4xx/5xx responses
+        r = requester.get(url, params=params, headers=headers, timeout=API_TIMEOUT, stream=stream)
+        try:
+            r.raise_for_status() # Raises HTTPError for 4xx/5xx responses
+        except requests.exceptions.HTTPError:
+            if stream:
+                r.close() # The unread streamed body would keep its pooled connection checked out
+            raise
+        if stream:
+            r.raw.decode_content = True # Let urllib3 undo any gzip/deflate encoding
+            return r
+        if orjson is not None:
+            return orjson.loads(r.content) # Decodes the raw bytes directly, no text decode step
         return r.json()
     except requests.exceptions.Timeout:
         print(f"ERROR: Timeout connecting to {url}")
@@ -81,7 +171,7 @@ def make_api_request(base_url, api_key, endpoint, params=None, session=None):
             # print(f"       Response: {e.response.text[:500]}...") # Uncomment for detailed API errors
     except requests.exceptions.RequestException as e:
         print(f"ERROR: Failed request to {url}: {e}")
-    except json.JSONDecodeError:
+    except json.JSONDecodeError: # Also covers orjson.JSONDecodeError, which subclasses it
         print(f"ERROR: Could not decode JSON response from {url}. Response: {r.text[:500]}...")
     return None # Indicate failure
 
@@ -90,7 +180,7 @@ def write_csv(rows, output_filename, fieldnames):
     Writes the processed data rows to a CSV file.
 
     Args:
-        rows (list): A list of dictionaries, where each dictionary represents a row.
+        rows (list): A list of tuples, one per row, with values in the same order as fieldnames.
         output_filename (str): The path to the output CSV file.
         fieldnames (list): A list of strings representing the CSV header columns.
     """
@@ -101,8 +191,9 @@ def write_csv(rows, output_filename, fieldnames):
     print(f"\nINFO: Writing {len(rows)} entries to {output_filename}...")
     try:
         with open(output_filename, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore') # Ignore extra fields if any
-            writer.writeheader()
+            # Rows are already in column order, so the plain writer needs no per-field lookups
+            writer = csv.writer(f)
+            writer.writerow(fieldnames)
             writer.writerows(rows)
         print(f"INFO: Successfully wrote data to {output_filename}")
     except IOError as e:
@@ -111,6 +202,79 @@ def write_csv(rows, output_filename, fieldnames):
         print(f"ERROR: An unexpected error occurred during CSV writing: {e}")
 
 
+def open_details_cache(cache_path):
+    """
+    Opens the SQLite cache of file details, creating its table if needed.
+
+    Args:
+        cache_path (str or None): Path to the SQLite cache file. None disables caching.
+
+    Returns:
+        sqlite3.Connection or None: The open cache connection, or None if disabled or unavailable.
+    """
+    if not cache_path:
+        return None
+    try:
+        cache = sqlite3.connect(cache_path)
+        cache.execute("CREATE TABLE IF NOT EXISTS file_cache (file_id INTEGER PRIMARY KEY, token TEXT, json BLOB)")
+        return cache
+    except sqlite3.Error as e:
+        print(f"WARNING: Could not open details cache {cache_path}: {e}. Continuing without cache.")
+        return None
+
+def make_cache_token(file_summary, quality_profile_id=None, score_fingerprint=""):
+    """
+    Builds the cache invalidation token for a file from its cheap summary fields.
+
+    Args:
+        file_summary (dict): The file summary embedded in the movie object.
+        quality_profile_id (int): The movie's quality profile ID, which its score depends on.
+        score_fingerprint (str): Fingerprint of the quality profiles' format scores.
+
+    Returns:
+        str: A token that changes whenever the file is replaced or its score configuration changes.
+    """
+    return f"{score_fingerprint}|{quality_profile_id}|{file_summary.get('dateAdded', '')}|{file_summary.get('size', 0)}"
+
+def make_score_fingerprint(profiles):
+    """
+    Hashes the custom format scores of the quality profiles, so cached details
+    (whose 'customFormatScore' depends on them) are refetched after a score change.
+
+    Args:
+        profiles (list): Quality profile dictionaries from the Radarr API.
+
+    Returns:
+        str: A short hex digest of the profiles' 'formatItems' scores.
+    """
+    format_scores = sorted(
+        (p.get('id', 0), sorted((item.get('format', 0), item.get('score', 0)) for item in p.get('formatItems') or () if isinstance(item, dict)))
+        for p in profiles if isinstance(p, dict)
+    )
+    return hashlib.sha1(json.dumps(format_scores).encode("utf-8")).hexdigest()[:16]
+
+def load_cached_details(cache, movie_file_ids):
+    """
+    Looks up cached file details for many files, in chunks of 500 to stay under
+    SQLite's bound parameter limit.
+
+    Args:
+        cache (sqlite3.Connection): The open details cache.
+        movie_file_ids (list): Movie file IDs to look up.
+
+    Returns:
+        dict: Map of movie file ID to (token, json) for the files found in the cache.
+    """
+    cached = {}
+    for start in range(0, len(movie_file_ids), 500):
+        chunk = movie_file_ids[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        for file_id, token, details_json in cache.execute(
+                f"SELECT file_id, token, json FROM file_cache WHERE file_id IN ({placeholders})", chunk):
+            cached[file_id] = (token, details_json)
+    return cached
+
+
 # --- Radarr Specific Functions ---
 
 def get_quality_profile_map(base_url, api_key, session):
@@ -123,23 +287,43 @@ def get_quality_profile_map(base_url, api_key, session):
         session (requests.Session): Requests session object.
 
     Returns:
-        dict: A dictionary mapping quality profile ID (int) to name (str).
-              Returns an empty dict if fetching fails.
+        tuple: (profile_map, score_fingerprint) - a dictionary mapping quality profile
+               ID (int) to name (str), and the fingerprint of the profiles' format
+               scores (see make_score_fingerprint). Returns ({}, "") if fetching fails.
     """
     print("INFO: Fetching Radarr quality profile mapping...")
     endpoint = "/api/v3/qualityprofile"
     profiles = make_api_request(base_url, api_key, endpoint, session=session)
     if profiles:
-        profile_map = {p['id']: p['name'] for p in profiles if 'id' in p and 'name' in p}
+        # Profile names repeat on most rows; intern them once here
+        profile_map = {p['id']: sys.intern(p['name']) for p in profiles if 'id' in p and 'name' in p}
         print(f"INFO: Successfully fetched {len(profile_map)} quality profiles.")
-        return profile_map
+        return profile_map, make_score_fingerprint(profiles)
     else:
         print("ERROR: Failed to fetch quality profiles. Profile names will be missing.")
-        return {}
+        return {}, ""
+
+def project_movie(movie):
+    """
+    Reduces a movie dictionary to the fields used during processing.
+
+    Args:
+        movie (dict): A full movie dictionary from the Radarr API.
+
+    Returns:
+        dict: A movie dictionary with only MOVIE_FIELDS and a reduced 'movieFile'.
+    """
+    slim_movie = {key: movie[key] for key in MOVIE_FIELDS if key in movie}
+    movie_file = movie.get("movieFile")
+    if isinstance(movie_file, dict):
+        slim_movie["movieFile"] = {key: movie_file[key] for key in MOVIE_FILE_FIELDS if key in movie_file}
+    return slim_movie
 
 def get_all_movies(base_url, api_key, session):
     """
-    Fetches all movies from Radarr.
+    Fetches all movies from Radarr, keeping only the fields used during processing.
+    If `ijson` is installed the response is parsed as a stream, so only one full
+    movie is held in memory at a time.
 
     Args:
         base_url (str): Radarr base URL.
@@ -151,7 +335,21 @@ def get_all_movies(base_url, api_key, session):
     """
     print(f"INFO: Fetching all movies from Radarr at {base_url}...")
     endpoint = "/api/v3/movie"
-    movies_data = make_api_request(base_url, api_key, endpoint, session=session)
+    params = {"excludeLocalCovers": "true"} # Skip local poster/fanart paths we never use
+    movies_data = None
+    if ijson is not None:
+        response = make_api_request(base_url, api_key, endpoint, params=params, session=session, stream=True)
+        if response is not None:
+            try:
+                movies_data = [project_movie(movie) for movie in ijson.items(response.raw, "item")]
+            except Exception as e:
+                print(f"ERROR: Could not stream-parse movie list from {base_url}{endpoint}: {e}")
+            finally:
+                response.close()
+    else:
+        full_movies = make_api_request(base_url, api_key, endpoint, params=params, session=session)
+        if full_movies is not None:
+            movies_data = [project_movie(movie) for movie in full_movies]
     if movies_data is not None:
         print(f"INFO: Successfully fetched {len(movies_data)} movies.")
         return movies_data
@@ -159,174 +357,253 @@ def get_all_movies(base_url, api_key, session):
         print("ERROR: Failed to fetch movies.")
         return None
 
-# --- Function to fetch details for ONE file (will be run in threads) ---
-def fetch_single_movie_file_details(args):
+# --- Function to fetch details for a BATCH of movies (will be run in threads) ---
+def fetch_movie_file_details_batch(args):
     """
-    Fetches details for a single movie file ID using the provided session.
+    Fetches movie file details for a batch of movie IDs in a single request.
+    Radarr's movieFile endpoint accepts a repeated 'movieId' query parameter,
+    so one call replaces up to MOVIE_FILE_BATCH_SIZE per-file requests.
     Designed to be called by ThreadPoolExecutor.
 
     Args:
-        args (tuple): A tuple containing (base_url, api_key, movie_file_id, session).
+        args (tuple): A tuple containing (base_url, api_key, movie_ids, session).
 
     Returns:
-        tuple: (movie_file_id, details_dict or None)
+        list or None: A list of movie file dictionaries if successful, None otherwise.
     """
-    base_url, api_key, movie_file_id, session = args
-    endpoint = f"/api/v3/movieFile/{movie_file_id}"
+    base_url, api_key, movie_ids, session = args
+    endpoint = "/api/v3/movieFile"
+    params = [("movieId", movie_id) for movie_id in movie_ids]
     # Use the passed session for potential connection reuse within threads
-    details = make_api_request(base_url, api_key, endpoint, session=session)
-    return movie_file_id, details # Return ID too, to match results later
+    return make_api_request(base_url, api_key, endpoint, params=params, session=session)
 
 
-# --- Main Processing Function (Parallel Version) ---
-def process_movies_and_scores_parallel(movies, base_url, api_key, quality_profile_map):
+# --- Per-Movie Helpers ---
+def iter_qualifying_movies(movies, score_fingerprint=""):
     """
-    Processes movies, fetches file details in parallel, extracts scores & profiles.
+    Yields the movies that have a file, with the info needed once file details arrive.
 
     Args:
         movies (list): List of movie dictionaries from Radarr API.
-        base_url (str): Radarr base URL.
-        api_key (str): Radarr API key.
-        quality_profile_map (dict): Map of quality profile IDs to names.
+        score_fingerprint (str): Fingerprint of the quality profiles' format scores.
 
-    Returns:
-        list: A list of dictionaries, each containing processed movie info,
-              sorted by score (descending). Returns empty list on failure or no data.
+    Yields:
+        tuple: (movie_info_dict, movie_file_id) for each movie with a file.
     """
-    if not movies:
-        print("INFO: No movie data provided for processing.")
-        return []
-
-    start_time = time.time()
-    files_to_process = [] # List to hold (movie_info_dict, movie_file_id) tuples
-
-    print("\nINFO: Phase 1: Identifying movies with files and extracting initial info...")
-    processed_count = 0
+    # Bind hot callables to locals once; LOAD_FAST is cheaper than attribute/global lookups
+    _mget = dict.get
+    _isinstance = isinstance
+    _make_cache_token = make_cache_token
+    _intern = sys.intern
     for movie in movies:
-        processed_count += 1
-        movie_file_summary = movie.get("movieFile")
+        movie_file_summary = _mget(movie, "movieFile")
         # Ensure movie has a file and the file summary exists
-        if movie.get("hasFile") and movie_file_summary and isinstance(movie_file_summary, dict):
-            movie_file_id = movie_file_summary.get("id")
-            quality_profile_id = movie.get("qualityProfileId") # Get profile ID from the movie object
+        if _mget(movie, "hasFile") and movie_file_summary and _isinstance(movie_file_summary, dict):
+            movie_file_id = _mget(movie_file_summary, "id")
+            quality_profile_id = _mget(movie, "qualityProfileId") # Get profile ID from the movie object
 
             if movie_file_id:
+                title = _mget(movie, "title", "N/A")
                 # Store essential info needed *after* file details are fetched
                 movie_info = {
-                    "Title": movie.get("title", "N/A"),
+                    "MovieId": _mget(movie, "id"), # Used to batch the file details requests
+                    "Title": _intern(title) if _isinstance(title, str) else title, # Interned: titles repeat and are sorted on
                     # Get path from summary - often sufficient and available earlier
-                    "File": movie_file_summary.get("relativePath", "N/A"),
+                    "File": _mget(movie_file_summary, "relativePath", "N/A"),
                     "QualityProfileId": quality_profile_id, # Store the ID
-                    "OriginalMovieFileId": movie_file_id # For matching later if needed
+                    "OriginalMovieFileId": movie_file_id, # For matching later if needed
+                    "CacheToken": _make_cache_token(movie_file_summary, quality_profile_id, score_fingerprint) # Invalidates cached details
                 }
-                files_to_process.append((movie_info, movie_file_id))
+                yield movie_info, movie_file_id
             # else:
             #    print(f"DEBUG: Movie '{movie.get('title', 'N/A')}' has file but no movieFile ID found in summary. Skipping.")
         # else:
             # print(f"DEBUG: Skipping movie '{movie.get('title', 'N/A')}' - No file or missing file summary.")
 
-    total_movies = len(movies)
-    print(f"INFO: Phase 1 completed. Identified {len(files_to_process)} movies with file IDs out of {total_movies} total movies.")
-    if not files_to_process:
-        print("INFO: No movies with processable files found.")
+def build_movie_row(movie_info, file_details, quality_profile_map):
+    """
+    Calculates the score and looks up the quality profile name for one movie file.
+
+    Args:
+        movie_info (dict): Info collected from the movie list (see iter_qualifying_movies).
+        file_details (dict): The movie file details from the Radarr API.
+        quality_profile_map (dict): Map of quality profile IDs to names.
+
+    Returns:
+        tuple: The CSV row for this movie, in RADARR_FIELDNAMES order.
+    """
+    # --- Score Calculation Logic ---
+    # Radarr API v3+ provides 'customFormatScore' directly in movieFile details; it is
+    # the score under the movie's quality profile, so a 0 there is a real 0.
+    total_score = file_details.get("customFormatScore")
+
+    # Fallback only when the field is genuinely missing: sum 'score' from 'customFormats'
+    if total_score is None:
+        total_score = 0
+        custom_formats_list = file_details.get("customFormats")
+        if custom_formats_list and isinstance(custom_formats_list, list):
+            try:
+                # Ensure cf is a dictionary and has 'score' before summing
+                current_sum = sum(cf.get('score', 0) for cf in custom_formats_list if isinstance(cf, dict))
+                if current_sum > 0:
+                    # print(f"DEBUG: Using summed score {current_sum} for {movie_info['Title']}") # Optional debug
+                    total_score = current_sum
+            except TypeError as e:
+                print(f"WARNING: Type error summing scores for '{movie_info['Title']}'. Formats list: {custom_formats_list}. Error: {e}")
+
+    # --- Quality Profile Lookup ---
+    profile_id = movie_info.get("QualityProfileId")
+    profile_name = quality_profile_map.get(profile_id)
+    if profile_name is None: # Only build the fallback string on a miss
+        profile_name = sys.intern(f"Unknown ID: {profile_id}") if profile_id else "N/A"
+
+    # Use path from summary info collected earlier
+    return (movie_info["Title"], movie_info["File"], total_score, profile_name)
+
+
+# --- Main Processing Function (Parallel Version) ---
+def process_movies_and_scores_parallel(movies, base_url, api_key, quality_profile_map, score_fingerprint=""):
+    """
+    Processes movies, fetches file details in parallel, extracts scores & profiles.
+
+    Movies are scanned in a single pass: a batch request is submitted as soon as
+    MOVIE_FILE_BATCH_SIZE movies needing details have been seen, and rows are built
+    by a completion callback as each batch finishes, so network I/O starts before
+    the scan finishes.
+
+    Args:
+        movies (list): List of movie dictionaries from Radarr API.
+        base_url (str): Radarr base URL.
+        api_key (str): Radarr API key.
+        quality_profile_map (dict): Map of quality profile IDs to names.
+        score_fingerprint (str): Fingerprint of the quality profiles' format scores,
+                                 used to invalidate the details cache.
+
+    Returns:
+        list: A list of row tuples in RADARR_FIELDNAMES order, sorted by score
+              (descending). Returns empty list on failure or no data.
+    """
+    if not movies:
+        print("INFO: No movie data provided for processing.")
         return []
 
-    print(f"\nINFO: Phase 2: Fetching {len(files_to_process)} movie file details using up to {MAX_WORKERS} parallel workers...")
-
-    file_details_map = {} # Dictionary to store results: movie_file_id -> details_dict
-    tasks = []
-    # Use one session for all threads in this phase for potential connection reuse
-    with requests.Session() as session:
-        # Prepare arguments for each task
-        for _, movie_file_id in files_to_process:
-            tasks.append((base_url, api_key, movie_file_id, session))
-
-        processed_count = 0
-        # Use ThreadPoolExecutor to run fetch_single_movie_file_details concurrently
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            # Create a mapping from future object to the original movie_file_id for error reporting
-            future_to_id = {executor.submit(fetch_single_movie_file_details, task): task[2] for task in tasks}
-
-            for future in concurrent.futures.as_completed(future_to_id):
-                original_id = future_to_id[future]
-                try:
-                    # Result is (movie_file_id, details_dict or None)
-                    file_id, details = future.result()
-                    if details: # Store only if fetch was successful
-                        file_details_map[file_id] = details
-                    # else: Fetch failed, error already printed by make_api_request
-
-                except Exception as exc:
-                    print(f'WARNING: Movie file ID {original_id} generated an exception during fetch: {exc}')
-
-                processed_count += 1
-                # Print progress periodically
-                if processed_count % 50 == 0 or processed_count == len(files_to_process):
-                    print(f"  Fetched details for {processed_count}/{len(files_to_process)} files...")
-
-    print(f"\nINFO: Phase 2 completed. Successfully fetched details for {len(file_details_map)} files.")
-
-    print("\nINFO: Phase 3: Processing results, calculating scores, and adding profile names...")
+    start_time = time.perf_counter()
     rows = []
-    processed_results_count = 0
+    qualifying_count = 0
+    cached_count = 0
+    batch_count = 0
+    fetched_count = 0
     skipped_count = 0
-    for movie_info, movie_file_id in files_to_process:
-        file_details = file_details_map.get(movie_file_id) # Get fetched details using ID
-
-        if file_details:
-            processed_results_count += 1
-            total_score = 0 # Default score
-
-            # --- Score Calculation Logic ---
-            # Radarr API v3+ usually provides 'customFormatScore' directly in movieFile details.
-            # Fallback to summing 'score' from 'customFormats' list if needed.
-
-            # Method 1: Try the direct 'customFormatScore' field
-            total_score = file_details.get("customFormatScore", 0)
-
-            # Method 2: Fallback if score is 0 or field missing
-            if total_score == 0:
-                custom_formats_list = file_details.get("customFormats")
-                if isinstance(custom_formats_list, list): # Check if it's a list
-                    try:
-                        # Ensure cf is a dictionary and has 'score' before summing
-                        current_sum = sum(cf.get('score', 0) for cf in custom_formats_list if isinstance(cf, dict))
-                        if current_sum > 0:
-                            # print(f"DEBUG: Using summed score {current_sum} for {movie_info['Title']}") # Optional debug
-                            total_score = current_sum
-                    except TypeError as e:
-                        print(f"WARNING: Type error summing scores for '{movie_info['Title']}' (File ID: {movie_file_id}). Formats list: {custom_formats_list}. Error: {e}")
-                        total_score = 0 # Reset score on error
-                # else:
-                    # print(f"DEBUG: No 'customFormats' list found or not a list for {movie_info['Title']}") # Optional debug
-
-            # --- Quality Profile Lookup ---
-            profile_id = movie_info.get("QualityProfileId")
-            profile_name = quality_profile_map.get(profile_id, f"Unknown ID: {profile_id}" if profile_id else "N/A")
-
-            # --- Append Row ---
-            rows.append({
-                "Title": movie_info["Title"],
-                "File": movie_info["File"], # Use path from summary info collected earlier
-                "Score": total_score,
-                "Quality Profile": profile_name # Add the profile name
-            })
-        else:
-            # Details couldn't be fetched for this file_id, skip it.
-            skipped_count += 1
-            # print(f"DEBUG: Skipping movie '{movie_info['Title']}' as file details (ID: {movie_file_id}) were not fetched.")
-
-    end_time = time.time()
-    print(f"\nINFO: Phase 3 completed. Processed {processed_results_count} results. Skipped {skipped_count} due to missing details.")
+    # Completion callbacks run on worker threads; they hand their results over under this lock
+    results_lock = threading.Lock()
+    fetched_rows = []
+    cache_updates = [] # (file_id, token, json) entries written once all batches are done
+
+    # Bind hot callables and globals to locals for the per-movie loops below
+    append_row = rows.append
+    build_row = build_movie_row
+    json_loads = json.loads
+    json_dumps = json.dumps
+    batch_size = MOVIE_FILE_BATCH_SIZE
+
+    # Serve unchanged files from the details cache; only fetch new or changed ones
+    cache = open_details_cache(RADARR_CACHE_DB)
+
+    def handle_batch(batch, future):
+        """Builds the rows for one completed batch ({movie_file_id: movie_info})."""
+        nonlocal fetched_count, skipped_count
+        batch_rows = []
+        batch_cache_updates = []
+        try:
+            details_list = future.result()
+            pop_info = batch.pop
+            # None means the fetch failed; error already printed by make_api_request
+            for details in details_list or ():
+                if not isinstance(details, dict):
+                    continue
+                movie_file_id = details.get("id")
+                movie_info = pop_info(movie_file_id, None)
+                if movie_info is None:
+                    continue
+                batch_rows.append(build_row(movie_info, details, quality_profile_map))
+                if cache is not None:
+                    batch_cache_updates.append((movie_file_id, movie_info["CacheToken"], json_dumps(details)))
+        except Exception as exc:
+            print(f'WARNING: Batch of {len(batch)} movie files generated an exception during fetch: {exc}')
+
+        with results_lock:
+            fetched_rows.extend(batch_rows)
+            cache_updates.extend(batch_cache_updates)
+            fetched_count += len(batch_rows)
+            skipped_count += len(batch) # Movies left in the batch got no details back; skip them
+            print(f"  Fetched details for {fetched_count + skipped_count} files...")
+
+    print(f"\nINFO: Identifying movies with files and fetching file details in batches of {MOVIE_FILE_BATCH_SIZE} using up to {MAX_WORKERS} parallel workers...")
+
+    # Use one session for all threads, pooled for MAX_WORKERS connections
+    with create_session() as session, concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+
+        def submit_batch(batch):
+            movie_ids = [movie_info["MovieId"] for movie_info in batch.values()]
+            future = executor.submit(fetch_movie_file_details_batch, (base_url, api_key, movie_ids, session))
+            # The executor owns the future; the callback carries the batch it belongs to
+            future.add_done_callback(partial(handle_batch, batch))
+
+        batch = {}
+        qualifying = iter_qualifying_movies(movies, score_fingerprint)
+        # Scan in chunks so the cache is queried with one IN (...) lookup per chunk
+        while True:
+            chunk = list(islice(qualifying, 500))
+            if not chunk:
+                break
+            cached_details = load_cached_details(cache, [movie_file_id for _, movie_file_id in chunk]) if cache is not None else {}
+            get_cached = cached_details.get
+            for movie_info, movie_file_id in chunk:
+                qualifying_count += 1
+                cached = get_cached(movie_file_id)
+                if cached and cached[0] == movie_info["CacheToken"]:
+                    append_row(build_row(movie_info, json_loads(cached[1]), quality_profile_map))
+                    cached_count += 1
+                    continue
+                batch[movie_file_id] = movie_info
+                if len(batch) >= batch_size:
+                    submit_batch(batch)
+                    batch_count += 1
+                    batch = {}
+        if batch:
+            submit_batch(batch)
+            batch_count += 1
+
+        print(f"INFO: Identified {qualifying_count} movies with file IDs out of {len(movies)} total movies "
+              f"({cached_count} loaded from cache, {qualifying_count - cached_count} to fetch in {batch_count} batch request(s)).")
+    # Leaving the executor block waits for every batch and its callback to finish
+
+    rows.extend(fetched_rows)
+    if cache is not None:
+        cache.executemany("INSERT OR REPLACE INTO file_cache (file_id, token, json) VALUES (?, ?, ?)", cache_updates)
+        cache.commit()
+        cache.close()
+
+    end_time = time.perf_counter()
+    print(f"\nINFO: Processing completed. Processed {len(rows)} results. Skipped {skipped_count} due to missing details.")
     print(f"INFO: Total processing time: {end_time - start_time:.2f} seconds.")
 
     if not rows:
         print("INFO: No movies with processable file details found after processing.")
         return []
 
-    # Sort by Score (descending), then by Title (ascending) as a secondary sort key
+    # Sort by Score (descending), then by Title (ascending) as a secondary sort key.
+    # File breaks remaining ties, since rows arrive in batch completion order.
+    if RADARR_TOP_N is not None:
+        # Only the top N rows are wanted: select them with a bounded heap instead of sorting everything
+        print(f"\nINFO: Selecting the top {RADARR_TOP_N} results by Score (descending), then Title...")
+        return heapq.nsmallest(RADARR_TOP_N, rows, key=lambda row: (-row[2], row[0], row[1]))
+
+    # Two stable passes with C-level itemgetter keys: Title/File first, then Score.
     print("\nINFO: Sorting results by Score (descending), then Title...")
-    return sorted(rows, key=lambda r: (-r["Score"], r["Title"]))
+    rows.sort(key=itemgetter(0, 1))
+    rows.sort(key=itemgetter(2), reverse=True)
+    return rows
 
 
 # --- Main Execution Logic ---
@@ -344,24 +621,27 @@ if __name__ == "__main__":
 
     all_movies = None
     quality_profile_map = {}
+    score_fingerprint = ""
     # Use a requests Session for potential keep-alive benefits across initial calls
-    with requests.Session() as main_session:
-        quality_profile_map = get_quality_profile_map(RADARR_URL, RADARR_API_KEY, main_session)
+    with create_session() as main_session, concurrent.futures.ThreadPoolExecutor(max_workers=2) as initial_executor:
+        # The two requests are independent: download the (large) movie list while the profiles load
+        profiles_future = initial_executor.submit(get_quality_profile_map, RADARR_URL, RADARR_API_KEY, main_session)
+        movies_future = initial_executor.submit(get_all_movies, RADARR_URL, RADARR_API_KEY, main_session)
+        quality_profile_map, score_fingerprint = profiles_future.result()
         # Only proceed if we could fetch profiles (basic connectivity check)
         if quality_profile_map is not None: # Check if it's not None (even if empty)
-            all_movies = get_all_movies(RADARR_URL, RADARR_API_KEY, main_session)
+            all_movies = movies_future.result()
         else:
+            movies_future.cancel()
             print("ERROR: Could not fetch quality profiles, cannot proceed.")
 
 
     if all_movies:
         # Call the parallel processing function, passing the profile map
-        scored_list = process_movies_and_scores_parallel(all_movies, RADARR_URL, RADARR_API_KEY, quality_profile_map)
+        scored_list = process_movies_and_scores_parallel(all_movies, RADARR_URL, RADARR_API_KEY, quality_profile_map, score_fingerprint)
 
         if scored_list:
-            # Define fieldnames for CSV header
-            radarr_fieldnames = ["Title", "File", "Score", "Quality Profile"]
-            write_csv(scored_list, RADARR_OUTPUT_CSV, radarr_fieldnames)
+            write_csv(scored_list, RADARR_OUTPUT_CSV, RADARR_FIELDNAMES)
         else:
             print("INFO: Processing yielded no data to write to CSV.")
     elif quality_profile_map is not None: # Only print this if profile fetch didn't already fail
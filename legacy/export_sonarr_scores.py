@@ -11,12 +11,50 @@ Requires:
     - Python 3.6+
     - `requests` library (install via pip: pip install requests)
     - Access to a Sonarr v3+ instance with API key.
+
+Optional:
+    - `httpx` library (pip install "httpx[http2]") to fetch the per-series episode
+      lists with asyncio over a single HTTP/2 connection instead of worker threads.
+    - `orjson` library (pip install orjson) for faster decoding of API responses.
+    - `brotli` library (pip install brotli) to accept brotli-compressed responses.
 """
+import asyncio
+import collections
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import csv
 import json
+import os
+import sqlite3
+import threading
 import time
 import concurrent.futures # For parallel processing
+import contextlib
+import functools
+import hashlib
+import itertools
+from operator import itemgetter
+
+try:
+    import httpx # Optional: async HTTP client for the per-series fetch fanout
+except ImportError:
+    httpx = None
+
+try:
+    import h2 # Optional: lets httpx use HTTP/2 (installed by httpx[http2])
+except ImportError:
+    h2 = None
+
+try:
+    import orjson # Optional: faster JSON decoding of API responses
+except ImportError:
+    orjson = None
+
+try:
+    import brotli # Optional: lets requests/urllib3 decode brotli ("br") responses
+except ImportError:
+    brotli = None
 
 # --- Configuration ---
 # ┌─────────────────────────────┐
@@ -26,14 +64,32 @@ SONARR_API_KEY    = "YOUR_APP_API_KEY_HERE"  # Replace with your actual Sonarr A
 SONARR_URL        = "http://127.0.0.1:8989" # Replace with your Sonarr URL (e.g., http://sonarr:8989 or https://sonarr.domain.com)
 SONARR_OUTPUT_CSV = "sonarr_custom_scores.csv" # Name of the output CSV file
 
+# SQLite file used to cache episode file details between runs, for Sonarr versions
+# that don't embed them in the episode list (those need a per-series file request),
+# e.g. "sonarr_cache.db". Set to None to disable the cache. A re-imported file gets a
+# new ID in Sonarr, so entries for replaced files are never reused. Entries are also
+# invalidated when a series moves to another quality profile or the custom format
+# scores in any quality profile change. Delete the cache file after editing custom
+# format conditions.
+SONARR_CACHE_DB = None
+
 # ┌─────────────────────────────┐
 # │    PERFORMANCE & TIMING     │
 # └─────────────────────────────┘
 # Number of parallel workers to fetch file details.
-# Adjust based on your system & Sonarr's responsiveness.
-# Start lower (e.g., 5-10) and increase if your system handles it well.
-# Too high might overload Sonarr or cause rate-limiting issues.
-MAX_WORKERS = 15
+# Can be overridden without editing the script via the SONARR_MAX_WORKERS environment variable.
+# The default, twice the CPU count capped at 8, suits a Sonarr on the local network: requests
+# there return in milliseconds, so more threads mostly contend for the GIL while decoding JSON.
+# Raise it for a remote or slow Sonarr; too high might overload Sonarr or cause rate-limiting issues.
+DEFAULT_MAX_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+try:
+    MAX_WORKERS = int(os.environ.get("SONARR_MAX_WORKERS") or 0) or DEFAULT_MAX_WORKERS # Unset, empty or 0: the default
+    if MAX_WORKERS < 0:
+        raise ValueError("must not be negative")
+except ValueError:
+    print(f"WARNING: Invalid SONARR_MAX_WORKERS value '{os.environ['SONARR_MAX_WORKERS']}'. "
+          f"Using the default of {DEFAULT_MAX_WORKERS} workers.")
+    MAX_WORKERS = DEFAULT_MAX_WORKERS
 
 # Seconds to wait for a response from the Sonarr API for each request.
 API_TIMEOUT = 30
@@ -43,34 +99,125 @@ API_TIMEOUT = 30
 # Useful for very slow servers or strict rate limiting. Keep at 0.0 for most cases.
 REQUEST_DELAY = 0.0
 
+# Maximum number of API requests per second across all worker threads.
+# Unlike REQUEST_DELAY, this paces requests globally, which avoids bursts that
+# trigger rate limiting (HTTP 429). Set to 0 to disable (default).
+MAX_REQUESTS_PER_SECOND = 0
+
 # --- Constants ---
-# (No user-configurable constants currently)
+# Failed requests (connection errors, timeouts and these status codes) are retried up to
+# RETRY_TOTAL times with exponential backoff; 429/503 responses honour Retry-After instead.
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.2
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Size of the CSV output buffer; large writes mean far fewer write() calls on slow or network disks.
+CSV_BUFFER_SIZE = 1024 * 1024
+# Rows are handed to the CSV writer in chunks of this size.
+CSV_CHUNK_ROWS = 1000
+# Minimum seconds between progress lines, so fast runs don't spend their time printing.
+PROGRESS_INTERVAL = 1.0
+# Layout version of the details cache; a cache file with another version is rebuilt.
+CACHE_SCHEMA_VERSION = 1
+# Episode list requests kept in flight per worker, ahead of the series being written.
+# Bounds how many episode lists are held at once, and how many requests a title group's
+# file requests queue behind.
+EPISODE_LISTS_AHEAD_PER_WORKER = 2
+
+# Endpoint of a single episode file; formatted with the file ID.
+EPISODE_FILE_ENDPOINT_TEMPLATE = "/api/v3/episodeFile/%d"
+
+# CSV header columns; each processed row is a tuple in this order.
+SONARR_FIELDNAMES = ("Series Title", "Episode", "Episode Title", "File", "Score", "Quality Profile")
 
 # --- Helper Functions ---
 
-def make_api_request(base_url, api_key, endpoint, params=None, session=None):
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter shared by all worker threads.
+
+    Tokens are added at refill_rate per second, up to capacity; each request takes one.
+
+    Args:
+        capacity (float): Maximum number of tokens, i.e. the largest allowed burst.
+        refill_rate (float): Number of tokens added per second.
+    """
+    def __init__(self, capacity, refill_rate):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available, then takes it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.refill_rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.refill_rate
+            time.sleep(wait) # Sleep outside the lock so other threads can refill/check
+
+# Shared limiter for make_api_request; None when MAX_REQUESTS_PER_SECOND is disabled
+_BUCKET = TokenBucket(max(1, MAX_REQUESTS_PER_SECOND), MAX_REQUESTS_PER_SECOND) if MAX_REQUESTS_PER_SECOND else None
+
+def create_session(api_key):
+    """
+    Creates the requests session shared by every request of the run, with a connection
+    pool sized for MAX_WORKERS.
+
+    The default HTTPAdapter only keeps 10 connections per host, so with more
+    worker threads than that, connections get discarded and re-opened instead
+    of being reused (keep-alive). The pool has headroom over MAX_WORKERS so the
+    main thread never has to wait for a worker's connection.
+
+    Args:
+        api_key (str): The API key, sent as a session header on every request.
+
+    Returns:
+        requests.Session: A session with a tuned HTTPAdapter mounted for http and https,
+                          asking for compressed responses.
+    """
+    session = requests.Session()
+    session.headers["X-Api-Key"] = api_key # Use header for API key - more standard
+    # Compressed JSON is 5-10x smaller; some reverse proxies only compress when asked explicitly.
+    # requests/urllib3 decompress it transparently; brotli only when urllib3 can decode it.
+    session.headers["Accept-Encoding"] = "gzip, deflate, br" if brotli is not None else "gzip, deflate"
+    adapter = HTTPAdapter(
+        pool_connections=MAX_WORKERS,
+        pool_maxsize=MAX_WORKERS * 2,
+        max_retries=Retry(total=RETRY_TOTAL, backoff_factor=RETRY_BACKOFF_FACTOR, status_forcelist=RETRY_STATUS_CODES)
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def make_api_request(base_url, endpoint, session, params=None):
     """
     Makes an API request to the specified endpoint with error handling.
 
     Args:
-        base_url (str): The base URL of the Radarr/Sonarr instance.
-        api_key (str): The API key for authentication.
+        base_url (str): The base URL of the Radarr/Sonarr instance, without a trailing slash.
         endpoint (str): The API endpoint (e.g., '/api/v3/series').
+        session (requests.Session): A session from create_session(), which carries the API key.
         params (dict, optional): Query parameters for the request. Defaults to None.
-        session (requests.Session, optional): A requests session object to use. Defaults to None.
 
     Returns:
         dict or None: The JSON response as a dictionary if successful, None otherwise.
     """
-    if params is None:
-        params = {}
-    headers = {"X-Api-Key": api_key} # Use header for API key - more standard
-    url = f"{base_url.rstrip('/')}{endpoint}" # Ensure no double slashes
-    requester = session or requests # Use provided session or default requests module
-    time.sleep(REQUEST_DELAY) # Apply delay before each request
+    url = base_url + endpoint # base_url is stripped once at startup
+    if REQUEST_DELAY:
+        time.sleep(REQUEST_DELAY) # Apply delay before each request
+    if _BUCKET is not None:
+        _BUCKET.acquire() # Pace requests globally across threads
     try:
-        r = requester.get(url, params=params, headers=headers, timeout=API_TIMEOUT)
+        r = session.get(url, params=params, timeout=API_TIMEOUT)
         r.raise_for_status() # Raises HTTPError for 4xx/5xx responses
+        if orjson is not None:
+            return orjson.loads(r.content) # Decodes the raw bytes directly, no text decode step
         return r.json()
     except requests.exceptions.Timeout:
         print(f"ERROR: Timeout connecting to {url}")
@@ -81,87 +228,335 @@ def make_api_request(base_url, api_key, endpoint, params=None, session=None):
             # print(f"       Response: {e.response.text[:500]}...") # Uncomment for detailed API errors
     except requests.exceptions.RequestException as e:
         print(f"ERROR: Failed request to {url}: {e}")
-    except json.JSONDecodeError:
+    except json.JSONDecodeError: # Also covers orjson.JSONDecodeError, which subclasses it
         print(f"ERROR: Could not decode JSON response from {url}. Response: {r.text[:500]}...")
     return None # Indicate failure
 
-def write_csv(rows, output_filename, fieldnames):
+def get_retry_delay(attempt, response=None):
+    """
+    Returns the seconds to wait after failed attempt number `attempt` (0-based), the way
+    the session's urllib3 Retry does: a 429/503 response's numeric Retry-After if given,
+    otherwise no wait before the first retry and RETRY_BACKOFF_FACTOR * 2**attempt after.
     """
-    Writes the processed data rows to a CSV file.
+    if response is not None and response.status_code in (429, 503):
+        try:
+            return max(0.0, float(response.headers.get("Retry-After", "")))
+        except ValueError:
+            pass # Missing or an HTTP date; fall back to the backoff
+    return RETRY_BACKOFF_FACTOR * (2 ** attempt) if attempt else 0.0
+
+class AsyncApiClient:
+    """
+    Makes API requests on an httpx.AsyncClient, using HTTP/2 when h2 is installed.
+
+    An asyncio event loop runs in a background thread. submit() schedules a GET on it
+    and returns a concurrent.futures.Future, so results can be consumed with
+    as_completed() exactly like ThreadPoolExecutor futures. Up to MAX_WORKERS requests
+    are in flight at once, multiplexed over a single connection with HTTP/2.
+    Failed requests are retried like create_session()'s, see RETRY_TOTAL.
+    Use as a context manager.
+
+    Args:
+        base_url (str): The base URL of the Sonarr instance.
+        api_key (str): The API key for authentication.
+    """
+    def __init__(self, base_url, api_key):
+        self._base_url = base_url.rstrip('/')
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._open(api_key), self._loop).result()
+
+    async def _open(self, api_key):
+        # Created on the event loop thread so they bind to the right loop
+        self._semaphore = asyncio.Semaphore(MAX_WORKERS)
+        self._client = httpx.AsyncClient(
+            base_url=self._base_url,
+            http2=h2 is not None,
+            headers={"X-Api-Key": api_key},
+            timeout=API_TIMEOUT,
+            limits=httpx.Limits(max_connections=MAX_WORKERS, max_keepalive_connections=MAX_WORKERS)
+        )
+
+    async def _get(self, endpoint, params):
+        url = f"{self._base_url}{endpoint}"
+        async with self._semaphore:
+            for attempt in range(RETRY_TOTAL + 1):
+                if REQUEST_DELAY:
+                    await asyncio.sleep(REQUEST_DELAY)
+                if _BUCKET is not None:
+                    await self._loop.run_in_executor(None, _BUCKET.acquire) # Don't block the event loop
+                try:
+                    r = await self._client.get(endpoint, params=params)
+                    if r.status_code in RETRY_STATUS_CODES and attempt < RETRY_TOTAL:
+                        await asyncio.sleep(get_retry_delay(attempt, r))
+                        continue
+                    r.raise_for_status()
+                    if orjson is not None:
+                        return orjson.loads(r.content)
+                    return r.json()
+                except httpx.TransportError as e: # Connection errors and timeouts
+                    if attempt < RETRY_TOTAL:
+                        await asyncio.sleep(get_retry_delay(attempt))
+                        continue
+                    if isinstance(e, httpx.TimeoutException):
+                        print(f"ERROR: Timeout connecting to {url}")
+                    else:
+                        print(f"ERROR: Failed request to {url}: {e}")
+                except httpx.HTTPStatusError as e:
+                    # Log non-404 errors, as 404 might be expected in some checks
+                    if e.response.status_code != 404:
+                        print(f"ERROR: HTTP Error {e.response.status_code} for {url}")
+                except httpx.HTTPError as e:
+                    print(f"ERROR: Failed request to {url}: {e}")
+                except json.JSONDecodeError: # Also covers orjson.JSONDecodeError
+                    print(f"ERROR: Could not decode JSON response from {url}. Response: {r.text[:500]}...")
+                return None # Indicate failure
+
+    def submit(self, endpoint, params=None):
+        """Schedules a GET request; returns a concurrent.futures.Future for its JSON (or None)."""
+        return asyncio.run_coroutine_threadsafe(self._get(endpoint, params or {}), self._loop)
+
+    def close(self):
+        """Closes the client and stops the event loop."""
+        asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+class CsvSink:
+    """
+    Writes CSV rows to a file as they are produced, instead of collecting them first.
+
+    The file is only created once the first rows arrive, so a run that yields no
+    data does not leave an empty CSV behind. Rows are written in chunks of
+    CSV_CHUNK_ROWS through a CSV_BUFFER_SIZE buffer. Use as a context manager.
 
     Args:
-        rows (list): A list of dictionaries, where each dictionary represents a row.
         output_filename (str): The path to the output CSV file.
         fieldnames (list): A list of strings representing the CSV header columns.
     """
-    if not rows:
-        print("INFO: No data to write to CSV.")
-        return
+    def __init__(self, output_filename, fieldnames):
+        self.output_filename = output_filename
+        self.fieldnames = fieldnames
+        self.count = 0 # Number of rows written so far
+        self._file = None
+        self._writer = None
+        self._pending = [] # Rows not yet handed to the CSV writer
+
+    def writerow(self, row):
+        """Queues one row (a tuple with values in the same order as fieldnames) for writing."""
+        self._pending.append(row)
+        self.count += 1
+        if len(self._pending) >= CSV_CHUNK_ROWS:
+            self._write_pending()
+
+    def _write_pending(self):
+        """Writes the queued rows in one writerows call, opening the file on first use."""
+        if self._writer is None:
+            print(f"\nINFO: Writing entries to {self.output_filename}...")
+            self._file = open(self.output_filename, "w", newline="", encoding="utf-8", buffering=CSV_BUFFER_SIZE)
+            # Rows are already in column order, so the plain writer needs no per-field lookups
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(self.fieldnames)
+        self._writer.writerows(self._pending)
+        self._pending = []
+
+    def close(self):
+        """Writes any queued rows and closes the output file, if it was opened."""
+        if self._pending:
+            self._write_pending()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if exc_type is None and self.count:
+            print(f"INFO: Successfully wrote {self.count} entries to {self.output_filename}")
+        return False
+
+class ProfileNameMap(dict):
+    """
+    Quality profile ID -> name map that resolves unknown IDs to a fallback name.
 
-    print(f"\nINFO: Writing {len(rows)} entries to {output_filename}...")
+    The fallback is built on the first miss and stored, so each unknown ID costs
+    one string for the whole run and lookups never evaluate a default.
+    """
+    def __missing__(self, profile_id):
+        name = f"Unknown ID: {profile_id}" if profile_id else "N/A"
+        self[profile_id] = name
+        return name
+
+def open_details_cache(cache_path):
+    """
+    Opens the SQLite cache of episode file details, creating its table if needed.
+
+    Args:
+        cache_path (str or None): Path to the SQLite cache file. None disables caching.
+
+    Returns:
+        sqlite3.Connection or None: The open cache connection, or None if disabled or unavailable.
+    """
+    if not cache_path:
+        return None
     try:
-        with open(output_filename, "w", newline="", encoding="utf-8") as f:
-            # Ignore extra fields in case the dict has more keys than fieldnames
-            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
-            writer.writeheader()
-            writer.writerows(rows)
-        print(f"INFO: Successfully wrote data to {output_filename}")
-    except IOError as e:
-        print(f"ERROR: Could not write to CSV file {output_filename}: {e}")
-    except Exception as e:
-        print(f"ERROR: An unexpected error occurred during CSV writing: {e}")
+        cache = sqlite3.connect(cache_path)
+        # WAL lets a second export read the cache while this one writes; NORMAL sync is safe under WAL
+        cache.execute("PRAGMA journal_mode=WAL")
+        cache.execute("PRAGMA synchronous=NORMAL")
+        if cache.execute("PRAGMA user_version").fetchone()[0] != CACHE_SCHEMA_VERSION:
+            # Written by an older version of this script; it's only a cache, so start over
+            cache.execute("DROP TABLE IF EXISTS file_cache")
+            cache.execute(f"PRAGMA user_version = {CACHE_SCHEMA_VERSION}")
+        cache.execute(
+            "CREATE TABLE IF NOT EXISTS file_cache "
+            "(file_id INTEGER PRIMARY KEY, token TEXT, date_added TEXT, score INTEGER, relative_path TEXT, cf_json TEXT)"
+        )
+        return cache
+    except sqlite3.Error as e:
+        print(f"WARNING: Could not open details cache {cache_path}: {e}. Continuing without cache.")
+        return None
+
+def load_cached_file_details(cache, file_ids, cache_token):
+    """
+    Loads cached episode file details for the given file IDs.
+
+    Args:
+        cache (sqlite3.Connection): The open details cache.
+        file_ids (iterable): Episode file IDs to look up.
+        cache_token (str): The series' cache token (see make_cache_token); entries
+                           stored under another token are stale and ignored.
+
+    Returns:
+        dict: episode_file_id -> details dict (with the fields Phase 3 reads), for the IDs found.
+    """
+    file_ids = list(file_ids)
+    details = {}
+    # Older SQLite builds allow at most 999 parameters per statement
+    for start in range(0, len(file_ids), 500):
+        chunk = file_ids[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        cached = cache.execute(
+            f"SELECT file_id, date_added, score, relative_path, cf_json FROM file_cache WHERE file_id IN ({placeholders}) AND token = ?",
+            chunk + [cache_token]
+        )
+        for file_id, date_added, score, relative_path, cf_json in cached:
+            details[file_id] = {
+                "id": file_id,
+                "dateAdded": date_added,
+                "customFormatScore": score,
+                "relativePath": relative_path,
+                "customFormats": json.loads(cf_json) if cf_json else []
+            }
+    return details
+
+def make_cache_entry(file_details, cache_token):
+    """Returns the file_cache row (file_id, token, date_added, score, relative_path, cf_json) for an episode file."""
+    return (
+        file_details["id"],
+        cache_token,
+        file_details.get("dateAdded"),
+        file_details.get("customFormatScore"),
+        file_details.get("relativePath", "N/A"),
+        json.dumps(file_details.get("customFormats") or [])
+    )
+
+def make_cache_token(quality_profile_id, score_fingerprint):
+    """
+    Builds the cache token of a series' episode files. Their 'customFormatScore' is
+    the score under the series' quality profile, so it changes with either part.
+
+    Args:
+        quality_profile_id (int): The series' quality profile ID.
+        score_fingerprint (str): Fingerprint of the quality profiles' format scores.
+
+    Returns:
+        str: The token cached file details must match to be reused.
+    """
+    return f"{score_fingerprint}|{quality_profile_id}"
+
+def make_score_fingerprint(profiles):
+    """
+    Hashes the custom format scores of the quality profiles, so cached file details
+    are refetched after a score change.
+
+    Args:
+        profiles (list): Quality profile dictionaries from the Sonarr API.
+
+    Returns:
+        str: A short hex digest of the profiles' 'formatItems' scores.
+    """
+    format_scores = sorted(
+        (p.get('id', 0), sorted((item.get('format', 0), item.get('score', 0)) for item in p.get('formatItems') or () if isinstance(item, dict)))
+        for p in profiles if isinstance(p, dict)
+    )
+    return hashlib.sha1(json.dumps(format_scores).encode("utf-8")).hexdigest()[:16]
+
 
 # --- Sonarr Specific Functions ---
 
-def get_quality_profile_map(base_url, api_key, session):
+def get_quality_profile_map(base_url, session):
     """
     Fetches Sonarr quality profiles and returns a map of ID to Name.
 
     Args:
         base_url (str): Sonarr base URL.
-        api_key (str): Sonarr API key.
         session (requests.Session): Requests session object.
 
     Returns:
-        dict: A dictionary mapping quality profile ID (int) to name (str).
-              Returns an empty dict if fetching fails.
+        tuple: (profile_map, score_fingerprint) - a dictionary mapping quality profile
+               ID (int) to name (str), and the fingerprint of the profiles' format
+               scores (see make_score_fingerprint). Returns ({}, "") if fetching fails.
     """
     print("INFO: Fetching Sonarr quality profile mapping...")
     endpoint = "/api/v3/qualityprofile"
-    profiles = make_api_request(base_url, api_key, endpoint, session=session)
+    profiles = make_api_request(base_url, endpoint, session)
     if profiles:
         profile_map = {p['id']: p['name'] for p in profiles if 'id' in p and 'name' in p}
         print(f"INFO: Successfully fetched {len(profile_map)} quality profiles.")
-        return profile_map
+        return profile_map, make_score_fingerprint(profiles)
     else:
         print("ERROR: Failed to fetch quality profiles. Profile names will be missing.")
-        return {} # Return empty dict on failure
+        return {}, "" # Return empty map on failure
 
-def get_all_sonarr_series(base_url, api_key, session):
+def get_all_sonarr_series(base_url, session):
     """
     Fetches all series from Sonarr.
 
     Args:
         base_url (str): Sonarr base URL.
-        api_key (str): Sonarr API key.
         session (requests.Session): Requests session object.
 
     Returns:
-        dict or None: A map of seriesId -> {'title': seriesTitle, 'qualityProfileId': profileId}
-                      if successful, None otherwise.
+        dict or None: A map of seriesId -> {'title': seriesTitle, 'qualityProfileId': profileId,
+                      'episodeFileCount': fileCount or None} if successful, None otherwise.
     """
     print(f"INFO: Fetching all series from Sonarr at {base_url}...")
     endpoint = "/api/v3/series"
-    series_data = make_api_request(base_url, api_key, endpoint, session=session)
+    params = {"includeSeasonImages": "false"} # Images are never used; keep the payload small
+    series_data = make_api_request(base_url, endpoint, session, params=params)
     if series_data is not None:
         print(f"INFO: Successfully fetched {len(series_data)} series.")
-        # Create a map: seriesId -> {'title': seriesTitle, 'qualityProfileId': profileId}
+        # Create a map: seriesId -> {'title': seriesTitle, 'qualityProfileId': profileId, 'episodeFileCount': fileCount}
         series_map = {}
         for s in series_data:
             if 'id' in s and 'title' in s:
                 series_map[s['id']] = {
                     'title': s['title'],
-                    'qualityProfileId': s.get('qualityProfileId') # Use .get for safety if key is missing
+                    'qualityProfileId': s.get('qualityProfileId'), # Use .get for safety if key is missing
+                    # None if Sonarr didn't report statistics; only a known 0 lets us skip the series
+                    'episodeFileCount': (s.get('statistics') or {}).get('episodeFileCount')
                 }
             else:
                 print(f"WARNING: Skipping series entry due to missing 'id' or 'title': {s}")
@@ -170,80 +565,306 @@ def get_all_sonarr_series(base_url, api_key, session):
         print("ERROR: Failed to fetch series.")
         return None
 
-def get_sonarr_episodes_for_series(base_url, api_key, series_id, session):
+def get_sonarr_episodes_for_series(base_url, series_id, session):
     """
-    Fetches all episodes for a specific series ID from Sonarr.
+    Fetches all episodes for a specific series ID from Sonarr, with each episode's
+    file details embedded under 'episodeFile'.
 
     Args:
         base_url (str): Sonarr base URL.
-        api_key (str): Sonarr API key.
         series_id (int): The ID of the series to fetch episodes for.
         session (requests.Session): Requests session object.
 
     Returns:
         list or None: A list of episode dictionaries if successful, None otherwise.
     """
-    endpoint = "/api/v3/episode"
-    params = {"seriesId": series_id}
+    endpoint, params = sonarr_episodes_request(series_id)
     # Use the session for potentially faster connection reuse
-    return make_api_request(base_url, api_key, endpoint, params=params, session=session)
+    return make_api_request(base_url, endpoint, session, params=params)
 
-# --- Function to fetch details for ONE file (will be run in threads) ---
-def fetch_single_episode_file_details(args):
+def sonarr_episodes_request(series_id):
+    """Returns the (endpoint, params) of the episode list request for a series."""
+    # includeEpisodeFile embeds the file details, so no separate file request is needed
+    return "/api/v3/episode", {"seriesId": series_id, "includeEpisodeFile": "true"}
+
+def get_sonarr_files_for_series(base_url, series_id, session):
     """
-    Fetches details for a single episode file ID using the provided session.
-    Designed to be called by ThreadPoolExecutor.
+    Fetches all episode files for a specific series ID from Sonarr in one request.
+    Used as a fallback when the episode list did not embed the file details.
 
     Args:
-        args (tuple): A tuple containing (base_url, api_key, episode_file_id, session).
+        base_url (str): Sonarr base URL.
+        series_id (int): The ID of the series to fetch episode files for.
+        session (requests.Session): Requests session object.
 
     Returns:
-        tuple: (episode_file_id, details_dict or None)
+        list or None: A list of episode file dictionaries if successful, None otherwise.
+    """
+    endpoint, params = sonarr_files_request(series_id)
+    return make_api_request(base_url, endpoint, session, params=params)
+
+def sonarr_files_request(series_id):
+    """Returns the (endpoint, params) of the episode file list request for a series."""
+    return "/api/v3/episodeFile", {"seriesId": series_id}
+
+def get_sonarr_episode_file(base_url, episode_file_id, session):
+    """
+    Fetches the details of a single episode file from Sonarr.
+    Last-resort fallback for series whose bulk episode file request failed.
+
+    Args:
+        base_url (str): Sonarr base URL.
+        episode_file_id (int): The ID of the episode file.
+        session (requests.Session): Requests session object.
+
+    Returns:
+        dict or None: The episode file dictionary if successful, None otherwise.
+    """
+    endpoint, params = sonarr_file_request(episode_file_id)
+    return make_api_request(base_url, endpoint, session, params=params)
+
+def sonarr_file_request(episode_file_id):
+    """Returns the (endpoint, params) of the request for a single episode file."""
+    return EPISODE_FILE_ENDPOINT_TEMPLATE % episode_file_id, None
+
+def iter_windowed(submit, items, window):
+    """
+    Yields the results of submit(item) for each item, in input order, keeping at most
+    `window` requests in flight. The next request is only submitted once a result is
+    consumed, so requests submitted by the consumer meanwhile don't queue behind the
+    whole input.
+
+    Args:
+        submit (callable): Schedules one request; returns a concurrent.futures.Future.
+        items (iterable): The arguments to submit, one request each.
+        window (int): Maximum number of submitted requests not yet consumed.
+
+    Yields:
+        The result of each request.
+    """
+    items = iter(items)
+    pending = collections.deque(submit(item) for item in itertools.islice(items, window))
+    while pending:
+        future = pending.popleft()
+        for item in itertools.islice(items, 1):
+            pending.append(submit(item))
+        yield future.result()
+
+@functools.lru_cache(maxsize=None)
+def format_episode_id(season_num, episode_num):
+    """
+    Formats an episode identifier as SxxExx (e.g., S01E05).
+
+    The same (season, episode) pairs repeat across nearly every series, so results are cached.
     """
-    base_url, api_key, episode_file_id, session = args
-    endpoint = f"/api/v3/episodeFile/{episode_file_id}"
-    # Use the passed session for potential connection reuse within threads
-    details = make_api_request(base_url, api_key, endpoint, session=session)
-    return episode_file_id, details # Return ID too, to match results later
+    return "S%02dE%02d" % (season_num, episode_num)
 
 # --- Main Processing Function (Parallel Episode File Fetching) ---
-def process_sonarr_series_and_scores_parallel(series_map, base_url, api_key, quality_profile_map):
+def process_sonarr_series_and_scores_parallel(series_map, base_url, api_key, session, quality_profile_map, sink, score_fingerprint=""):
     """
     Processes series, fetches episodes, fetches file details in parallel, extracts scores & profiles.
+    Rows are written to the sink one title group at a time, as soon as the group is complete,
+    sorted by Series Title, then Episode.
 
     Args:
-        series_map (dict): Map of seriesId -> {'title': ..., 'qualityProfileId': ...}.
-        base_url (str): Sonarr base URL.
+        series_map (dict): Map of seriesId -> {'title': ..., 'qualityProfileId': ..., 'episodeFileCount': ...}.
+        base_url (str): Sonarr base URL, without a trailing slash.
         api_key (str): Sonarr API key.
+        session (requests.Session): The shared session from create_session().
         quality_profile_map (dict): Map of quality profile IDs to names.
+        sink (CsvSink): Destination for the processed rows.
+        score_fingerprint (str): Fingerprint of the quality profiles' format scores,
+                                 used to invalidate the details cache.
 
     Returns:
-        list: A list of dictionaries, each containing processed episode info,
-              sorted by Series Title, then Episode. Returns empty list on failure or no data.
+        int: The number of rows written to the sink. Returns 0 on failure or no data.
     """
     if not series_map:
         print("INFO: No series data provided for processing.")
-        return []
+        return 0
 
-    start_time = time.time()
-    episodes_to_process = [] # List to hold (episode_info_dict, episode_file_id) tuples
+    start_time = time.perf_counter()
     total_series = len(series_map)
     processed_series_count = 0
     total_episodes_found = 0
+    total_unique_files = 0
+    total_file_requests = 0
+    fetched_files_count = 0
+
+    # Only the files of the title group being assembled are held here: episode_file_id -> details_dict
+    file_details_map = {}
+    cached_files_count = 0
+    cache_updates = [] # file_cache rows for the files fetched from Sonarr
+
+    # Files that have to be fetched from Sonarr are served from this cache when possible
+    cache = open_details_cache(SONARR_CACHE_DB)
+
+    # Series without any episode files have nothing to export; don't request their episode lists.
+    # The rest are fetched in title order, so each title's rows can be written as soon as its series are in.
+    series_to_fetch = sorted(
+        (
+            (series_info.get('title', f"Unknown Series (ID: {series_id})"), series_id, series_info)
+            for series_id, series_info in series_map.items()
+            if series_info.get('episodeFileCount') != 0
+        ),
+        key=itemgetter(0)
+    )
+
+    # Bind hot callables to locals once; LOAD_FAST is cheaper than attribute/global lookups
+    writerow = sink.writerow
+    _get = dict.get
+    get_file_details = file_details_map.get
+    by_episode = itemgetter(0, 1) # Numeric (season, episode); "S01E100" would sort before "S01E99" as text
+
+    # Unknown profile IDs resolve to their fallback name once, so the row loop is a plain lookup
+    profile_names = ProfileNameMap(quality_profile_map)
+    processed_results_count = 0
+    skipped_count = 0
+    malformed_formats_reported = False # 'customFormats' that isn't a list is reported once, not per file
+
+    def store_file_details(file_details, cache_token):
+        if isinstance(file_details, dict) and 'id' in file_details: # Store only if fetch was successful
+            file_details_map[file_details['id']] = file_details
+            if cache is not None:
+                cache_updates.append(make_cache_entry(file_details, cache_token))
+            return True
+        return False
+
+    def write_title_group(series_title, title_episodes, files_futures):
+        """Waits for a title group's episode files, then writes its rows and drops its file details."""
+        nonlocal fetched_files_count, processed_results_count, skipped_count, malformed_formats_reported
+        single_file_tokens = {} # Files of series whose bulk request failed, fetched one by one -> cache token
+        for series_id, missing_file_ids, cache_token, future in files_futures:
+            try:
+                episode_files = future.result()
+                if isinstance(episode_files, list):
+                    for file_details in episode_files:
+                        fetched_files_count += store_file_details(file_details, cache_token)
+                else:
+                    # Bulk fetch failed (e.g. a 404 from a Sonarr without the seriesId filter); fall back per file
+                    print(f"WARNING: Could not fetch episode files for series '{series_title}' (ID: {series_id}) in bulk. "
+                          f"Fetching its {len(missing_file_ids)} files individually.")
+                    single_file_tokens.update(dict.fromkeys(missing_file_ids, cache_token))
+
+            except Exception as exc:
+                print(f"WARNING: Episode files for series '{series_title}' (ID: {series_id}) generated an exception during fetch: {exc}")
+
+        # Request each file once, even if several series listed it, and skip any that
+        # another series' bulk response brought along already
+        single_file_ids = [file_id for file_id in single_file_tokens if file_id not in file_details_map]
+        for file_id, file_details in zip(single_file_ids, map_single_files(single_file_ids)):
+            fetched_files_count += store_file_details(file_details, single_file_tokens[file_id])
+
+        # Episodes usually arrive in episode order already, so this sort is cheap
+        title_episodes.sort(key=by_episode)
+        for _, _, episode_id, episode_title, quality_profile_id, episode_file_id in title_episodes:
+            file_details = get_file_details(episode_file_id) # Get fetched details using ID
+
+            if file_details:
+                processed_results_count +=1
+
+                # --- Score Calculation Logic ---
+                # Sonarr API v3+ provides 'customFormatScore' directly in episodeFile details;
+                # it is the score under the series' quality profile, so a 0 there is a real 0.
+                total_score = _get(file_details, "customFormatScore")
+
+                # Fallback only when the field is genuinely missing: sum 'score' from 'customFormats'
+                if total_score is None:
+                    total_score = 0
+                    custom_formats_list = _get(file_details, "customFormats")
+                    if type(custom_formats_list) is list:
+                        # Plain loop over the bound dict.get; formats without a score or that
+                        # aren't dicts count as 0, so no exception handling is needed
+                        current_sum = 0
+                        for cf in custom_formats_list:
+                            if type(cf) is dict:
+                                current_sum += _get(cf, "score", 0)
+                        if current_sum > 0:
+                            total_score = current_sum
+                    elif custom_formats_list is not None and not malformed_formats_reported:
+                        malformed_formats_reported = True
+                        print(f"WARNING: Unexpected 'customFormats' data for file ID {episode_file_id}: expected a list, "
+                              f"got {type(custom_formats_list)}. Such files are scored 0; further occurrences are not reported.")
+
+                # --- Quality Profile Lookup ---
+                # Use the profile ID stored from the series info earlier
+                profile_name = profile_names[quality_profile_id]
+
+                # --- Write Row (in SONARR_FIELDNAMES order) ---
+                writerow((
+                    series_title,
+                    episode_id,
+                    episode_title,
+                    _get(file_details, "relativePath", "N/A"), # Get file path from the detailed file info
+                    total_score,
+                    profile_name # Add the profile name
+                ))
+            else:
+                # Details couldn't be fetched for this file_id, skip it.
+                skipped_count += 1
+                # print(f"DEBUG: Skipping episode '{series_title} {episode_id}' as file details (ID: {episode_file_id}) were not fetched.")
+
+        # The group is written; its file details are no longer needed
+        file_details_map.clear()
+
+    # Use one transport for all requests: httpx over HTTP/2 if installed, otherwise a thread pool
+    # sharing the run's session, pooled for MAX_WORKERS connections.
+    # Only a window of episode list requests is in flight ahead of the series being processed, so a
+    # title group's file requests queue behind that window rather than the whole library, and are
+    # fetched while the following episode lists are still arriving.
+    with contextlib.ExitStack() as stack:
+        if httpx is not None:
+            transport = f"httpx ({'HTTP/2' if h2 is not None else 'HTTP/1.1'}) with up to {MAX_WORKERS} concurrent requests"
+            api_client = stack.enter_context(AsyncApiClient(base_url, api_key))
+
+            submit_episodes = lambda series_id: api_client.submit(*sonarr_episodes_request(series_id))
+            submit_files = lambda series_id: api_client.submit(*sonarr_files_request(series_id))
+            map_single_files = lambda file_ids: [
+                future.result() for future in [api_client.submit(*sonarr_file_request(file_id)) for file_id in file_ids]
+            ]
+        else:
+            transport = f"up to {MAX_WORKERS} parallel workers"
+            executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS))
+            # get_sonarr_episodes_for_series returns None on failure, so one bad series can't end the loop
+            submit_episodes = functools.partial(executor.submit, get_sonarr_episodes_for_series, base_url, session=session)
+            submit_files = functools.partial(executor.submit, get_sonarr_files_for_series, base_url, session=session)
+            map_single_files = lambda file_ids: executor.map(
+                functools.partial(get_sonarr_episode_file, base_url, session=session), file_ids
+            )
+
+        print(f"\nINFO: Fetching episode data for all series using {transport}...")
+        print("INFO: Episode file details come embedded in the episode lists; missing ones are fetched per series.")
+        print("INFO: Rows are written per series title as soon as its data is complete.")
+        skipped_series_count = total_series - len(series_to_fetch)
+        if skipped_series_count:
+            print(f"INFO: Skipping {skipped_series_count} series without episode files.")
+
+        # Series sharing a title are adjacent after the sort; a title group is complete when the title changes
+        group_title = None
+        # (season, episode, episode ID, episode title, quality profile ID, episode file ID) tuples
+        group_episodes = []
+        group_files_futures = [] # (seriesId, missing file IDs, cache token, future) entries
+
+        last_progress_time = time.monotonic()
+        episode_lists = iter_windowed(
+            submit_episodes, (series_id for _, series_id, _ in series_to_fetch), MAX_WORKERS * EPISODE_LISTS_AHEAD_PER_WORKER
+        )
+        for (series_title, series_id, series_info), episodes in zip(series_to_fetch, episode_lists):
+            if series_title != group_title:
+                write_title_group(group_title, group_episodes, group_files_futures)
+                group_title = series_title
+                group_episodes = []
+                group_files_futures = []
 
-    print("\nINFO: Phase 1: Fetching episode data for all series (sequentially per series)...")
-    # Use a single session for fetching episode lists for better connection reuse
-    with requests.Session() as session:
-        for series_id, series_info in series_map.items():
-            series_title = series_info.get('title', f"Unknown Series (ID: {series_id})")
             series_quality_profile_id = series_info.get('qualityProfileId') # Get profile ID for this series
+            cache_token = make_cache_token(series_quality_profile_id, score_fingerprint)
 
             processed_series_count += 1
-            # Print progress periodically
-            if processed_series_count % 20 == 0 or processed_series_count == total_series:
-                print(f"  Fetching episodes for Series {processed_series_count}/{total_series}: {series_title}...")
-
-            episodes = get_sonarr_episodes_for_series(base_url, api_key, series_id, session)
+            # Print progress at most once per PROGRESS_INTERVAL, and always for the last series
+            now = time.monotonic()
+            if now - last_progress_time >= PROGRESS_INTERVAL or processed_series_count == len(series_to_fetch):
+                last_progress_time = now
+                print(f"  Processed Series {processed_series_count}/{len(series_to_fetch)}: {series_title}...")
 
             if episodes is None:
                 print(f"WARNING: Failed to fetch episodes for series '{series_title}' (ID: {series_id}). Skipping this series.")
@@ -253,7 +874,8 @@ def process_sonarr_series_and_scores_parallel(series_map, base_url, api_key, qua
                 print(f"WARNING: Unexpected data format for episodes of series '{series_title}' (ID: {series_id}). Expected list, got {type(episodes)}. Skipping.")
                 continue
 
-            series_episode_count = 0
+            series_episode_count = len(group_episodes)
+            series_file_ids = set() # Multi-episode files appear once per episode; count each file once
             for episode in episodes:
                 # Ensure episode is a dictionary and has the necessary keys
                 if isinstance(episode, dict) and episode.get("hasFile") and episode.get("episodeFileId", 0) > 0:
@@ -261,128 +883,63 @@ def process_sonarr_series_and_scores_parallel(series_map, base_url, api_key, qua
                     season_num = episode.get("seasonNumber", 0)
                     episode_num = episode.get("episodeNumber", 0)
 
-                    # Store essential info needed *after* file details are fetched
-                    episode_info = {
-                        "Series Title": series_title,
-                        "Episode": f"S{season_num:02d}E{episode_num:02d}", # Formatted episode identifier
-                        "Episode Title": episode.get("title", "N/A"),
-                        "QualityProfileId": series_quality_profile_id, # Store the series' profile ID
-                        "OriginalEpisodeFileId": episode_file_id # Keep for matching later if needed
-                    }
-                    episodes_to_process.append((episode_info, episode_file_id))
-                    series_episode_count += 1
-
-            total_episodes_found += series_episode_count
-            # print(f"DEBUG: Found {series_episode_count} episodes with files for series '{series_title}'.") # Optional debug
-
-    print(f"\nINFO: Phase 1 completed. Found {len(episodes_to_process)} episodes with files across {total_series} series.")
-    if not episodes_to_process:
-        print("INFO: No episodes with files found to process further.")
-        return []
-
-    print(f"\nINFO: Phase 2: Fetching {len(episodes_to_process)} episode file details using up to {MAX_WORKERS} parallel workers...")
-
-    file_details_map = {} # Dictionary to store results: episode_file_id -> details_dict
-    tasks = []
-    # Use one session for all threads in this phase for potential connection reuse
-    with requests.Session() as session:
-        # Prepare arguments for each task
-        for _, episode_file_id in episodes_to_process:
-            tasks.append((base_url, api_key, episode_file_id, session))
-
-        processed_count = 0
-        # Use ThreadPoolExecutor to run fetch_single_episode_file_details concurrently
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            # Create a mapping from future object to the original episode_file_id for error reporting
-            future_to_id = {executor.submit(fetch_single_episode_file_details, task): task[2] for task in tasks}
-
-            for future in concurrent.futures.as_completed(future_to_id):
-                original_id = future_to_id[future]
-                try:
-                    # Result is (episode_file_id, details_dict or None)
-                    file_id, details = future.result()
-                    if details: # Store only if fetch was successful
-                        file_details_map[file_id] = details
-                    # else: Fetch failed, error already printed by make_api_request
-
-                except Exception as exc:
-                    print(f'WARNING: Episode file ID {original_id} generated an exception during fetch: {exc}')
-
-                processed_count += 1
-                # Print progress periodically
-                if processed_count % 100 == 0 or processed_count == len(episodes_to_process):
-                    print(f"  Fetched details for {processed_count}/{len(episodes_to_process)} files...")
-
+                    # Store essential info needed *after* file details are fetched; a tuple is far
+                    # smaller than a dict per episode. The series title is the group's title.
+                    group_episodes.append((
+                        season_num,
+                        episode_num, # Sort key, together with the season
+                        format_episode_id(season_num, episode_num), # Formatted episode identifier
+                        episode.get("title", "N/A"),
+                        series_quality_profile_id, # The series' profile ID
+                        episode_file_id # Used to look up the file details when writing
+                    ))
+                    series_file_ids.add(episode_file_id)
+
+                    episode_file = episode.get("episodeFile")
+                    if isinstance(episode_file, dict):
+                        file_details_map[episode_file_id] = episode_file
+
+            total_episodes_found += len(group_episodes) - series_episode_count
+            total_unique_files += len(series_file_ids)
+            # A file only needs fetching if none of its episodes embedded it and it isn't cached
+            missing_file_ids = series_file_ids - file_details_map.keys()
+            if missing_file_ids and cache is not None:
+                cached_details = load_cached_file_details(cache, missing_file_ids, cache_token)
+                file_details_map.update(cached_details)
+                cached_files_count += len(cached_details)
+                missing_file_ids -= cached_details.keys()
+            if missing_file_ids:
+                # Older Sonarr versions ignore includeEpisodeFile; fetch the series' files in one request
+                group_files_futures.append((series_id, missing_file_ids, cache_token, submit_files(series_id)))
+                total_file_requests += 1
+
+        write_title_group(group_title, group_episodes, group_files_futures) # The last title group
+
+    if cache is not None:
+        cache.executemany(
+            "INSERT OR REPLACE INTO file_cache (file_id, token, date_added, score, relative_path, cf_json) VALUES (?, ?, ?, ?, ?, ?)",
+            cache_updates
+        )
+        cache.commit()
+        cache.close()
 
-    print(f"\nINFO: Phase 2 completed. Successfully fetched details for {len(file_details_map)} files.")
+    print(f"\nINFO: Found {total_episodes_found} episodes with files ({total_unique_files} unique files) across {total_series} series.")
+    if cached_files_count:
+        print(f"INFO: Loaded {cached_files_count} episode files from the details cache.")
+    if total_file_requests:
+        print(f"INFO: Fetched details for {fetched_files_count} episode files of {total_file_requests} series.")
 
-    print("\nINFO: Phase 3: Processing results, calculating scores, and adding profile names...")
-    rows = []
-    processed_results_count = 0
-    skipped_count = 0
-    for episode_info, episode_file_id in episodes_to_process:
-        file_details = file_details_map.get(episode_file_id) # Get fetched details using ID
-
-        if file_details:
-            processed_results_count +=1
-            relative_path = file_details.get("relativePath", "N/A")
-            total_score = 0
-
-            # --- Score Calculation Logic ---
-            # Sonarr API v3+ usually provides 'customFormatScore' directly in episodeFile details.
-            # Fallback to summing 'score' from 'customFormats' list if needed.
-
-            # Method 1: Try the direct 'customFormatScore' field
-            total_score = file_details.get("customFormatScore", 0)
-
-            # Method 2: Fallback if score is 0 or field missing
-            if total_score == 0:
-                custom_formats_list = file_details.get("customFormats")
-                if isinstance(custom_formats_list, list): # Check if it's a list
-                    try:
-                        # Ensure cf is a dictionary and has 'score' before summing
-                        current_sum = sum(cf.get('score', 0) for cf in custom_formats_list if isinstance(cf, dict))
-                        if current_sum > 0:
-                            # print(f"DEBUG: Using summed score {current_sum} for {episode_info['Series Title']} {episode_info['Episode']}") # Optional debug
-                            total_score = current_sum
-                    except TypeError as e:
-                        print(f"WARNING: Type error summing scores for {episode_info['Series Title']} {episode_info['Episode']} (File ID: {episode_file_id}). Formats: {custom_formats_list}. Error: {e}")
-                        total_score = 0 # Reset on error
-                # else:
-                    # print(f"DEBUG: No 'customFormats' list found or not a list for {episode_info['Series Title']} {episode_info['Episode']}") # Optional debug
-
-
-            # --- Quality Profile Lookup ---
-            # Use the profile ID stored from the series info earlier
-            profile_id = episode_info.get("QualityProfileId")
-            profile_name = quality_profile_map.get(profile_id, f"Unknown ID: {profile_id}" if profile_id else "N/A")
-
-            # --- Append Row ---
-            rows.append({
-                "Series Title": episode_info["Series Title"],
-                "Episode": episode_info["Episode"],
-                "Episode Title": episode_info["Episode Title"],
-                "File": relative_path, # Get file path from the detailed file info
-                "Score": total_score,
-                "Quality Profile": profile_name # Add the profile name
-            })
-        else:
-            # Details couldn't be fetched for this file_id, skip it.
-            skipped_count += 1
-            # print(f"DEBUG: Skipping episode '{episode_info['Series Title']} {episode_info['Episode']}' as file details (ID: {episode_file_id}) were not fetched.")
+    if not total_episodes_found:
+        print("INFO: No episodes with files found to process further.")
+        return 0
 
-    end_time = time.time()
-    print(f"\nINFO: Phase 3 completed. Processed {processed_results_count} results. Skipped {skipped_count} due to missing details.")
+    end_time = time.perf_counter()
+    print(f"\nINFO: Processing completed. Processed {processed_results_count} results. Skipped {skipped_count} due to missing details.")
     print(f"INFO: Total processing time: {end_time - start_time:.2f} seconds.")
 
-    if not rows:
+    if not processed_results_count:
         print("INFO: No episodes with processable file details found after processing.")
-        return []
-
-    # Sort by Series Title (ascending), then by Episode identifier (ascending)
-    print("\nINFO: Sorting results by Series Title, then Episode...")
-    # The SxxExx format sorts correctly lexicographically
-    return sorted(rows, key=lambda r: (r["Series Title"], r["Episode"]))
+    return processed_results_count
 
 
 # --- Main Execution Logic ---
@@ -398,31 +955,36 @@ if __name__ == "__main__":
         print(f"       Please update SONARR_API_KEY in the script.")
         exit(1) # Exit if API key is missing
 
+    sonarr_base_url = SONARR_URL.rstrip('/') # Strip once here, so requests don't have to
     all_sonarr_series = None
     quality_profile_map = {}
-    # Use a requests Session for potential keep-alive benefits across initial calls
-    with requests.Session() as main_session:
-        quality_profile_map = get_quality_profile_map(SONARR_URL, SONARR_API_KEY, main_session)
-        # Only proceed if we could fetch profiles (basic connectivity check)
-        if quality_profile_map is not None: # Check if it's not None (even if empty)
-            all_sonarr_series = get_all_sonarr_series(SONARR_URL, SONARR_API_KEY, main_session)
-        else:
-            print("ERROR: Could not fetch quality profiles, cannot proceed.")
-
-
-    if all_sonarr_series: # Check if series map is not None and not empty
-        # Call the parallel processing function, passing the profile map
-        sonarr_scored_list = process_sonarr_series_and_scores_parallel(
-            all_sonarr_series, SONARR_URL, SONARR_API_KEY, quality_profile_map
-        )
-
-        if sonarr_scored_list:
-            # Define fieldnames for CSV header
-            sonarr_fieldnames = ["Series Title", "Episode", "Episode Title", "File", "Score", "Quality Profile"]
-            write_csv(sonarr_scored_list, SONARR_OUTPUT_CSV, sonarr_fieldnames)
-        else:
-            print("INFO: Processing yielded no data to write to CSV.")
-    elif quality_profile_map is not None: # Only print this if profile fetch didn't already fail
-        print("ERROR: Could not retrieve Sonarr series list. Exiting Sonarr export.")
+    score_fingerprint = ""
+    # One requests Session for the whole run, so every request reuses the same keep-alive pool
+    with create_session(SONARR_API_KEY) as session:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as initial_executor:
+            # The two requests are independent: download the (large) series list while the profiles load
+            profiles_future = initial_executor.submit(get_quality_profile_map, sonarr_base_url, session)
+            series_future = initial_executor.submit(get_all_sonarr_series, sonarr_base_url, session)
+            quality_profile_map, score_fingerprint = profiles_future.result()
+            # Only proceed if we could fetch profiles (basic connectivity check)
+            if quality_profile_map is not None: # Check if it's not None (even if empty)
+                all_sonarr_series = series_future.result()
+            else:
+                series_future.cancel()
+                print("ERROR: Could not fetch quality profiles, cannot proceed.")
+
+        if all_sonarr_series: # Check if series map is not None and not empty
+            try:
+                # Call the parallel processing function, passing the profile map and the CSV sink
+                with CsvSink(SONARR_OUTPUT_CSV, SONARR_FIELDNAMES) as sink:
+                    written_count = process_sonarr_series_and_scores_parallel(
+                        all_sonarr_series, sonarr_base_url, SONARR_API_KEY, session, quality_profile_map, sink, score_fingerprint
+                    )
+                if not written_count:
+                    print("INFO: Processing yielded no data to write to CSV.")
+            except IOError as e:
+                print(f"ERROR: Could not write to CSV file {SONARR_OUTPUT_CSV}: {e}")
+        elif quality_profile_map is not None: # Only print this if profile fetch didn't already fail
+            print("ERROR: Could not retrieve Sonarr series list. Exiting Sonarr export.")
 
     print("\n--- Sonarr Score & Profile Export Finished ---")
@@ -5,14 +5,14 @@ Provides advanced analytics, upgrade candidate identification, trend analysis,
 and library optimization recommendations based on TRaSH Guides scoring data.
 """
 
-import statistics
+import heapq
 import sqlite3
 from collections import defaultdict, Counter
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple, Any
+from typing import Dict, Iterator, List, Optional, Tuple, Any
 from dataclasses import dataclass
 
-from ..models import MediaFile, LibraryStats, DatabaseManager, ScoreChangeType
+from ..models import MediaFile, LibraryStats, DatabaseManager, ScoreChangeType, FormatFlags
 
 
 @dataclass
@@ -28,6 +28,9 @@ class UpgradeCandidate:
 @dataclass
 class QualityProfileAnalysis:
     """Analysis of a quality profile's performance."""
+    __slots__ = ('profile_name', 'file_count', 'avg_score', 'score_distribution',
+                 'common_issues', 'recommendations', 'effectiveness_rating')
+    
     profile_name: str
     file_count: int
     avg_score: float
@@ -40,6 +43,9 @@ class QualityProfileAnalysis:
 @dataclass
 class CustomFormatEffectiveness:
     """Analysis of custom format effectiveness."""
+    __slots__ = ('format_name', 'usage_count', 'avg_score_contribution', 'files_with_format',
+                 'impact_rating', 'recommendations')
+    
     format_name: str
     usage_count: int
     avg_score_contribution: float
@@ -78,34 +84,109 @@ class LibraryHealthReport:
 class IntelligentAnalyzer:
     """Advanced analytics engine for library optimization."""
     
+    # Count and score distribution of every quality profile
+    PROFILE_AGGREGATE_SQL = """
+        SELECT
+            quality_profile_name,
+            COUNT(*) as file_count,
+            AVG(total_score) as avg_score,
+            SUM(CASE WHEN total_score > 100 THEN 1 ELSE 0 END) as excellent,
+            SUM(CASE WHEN total_score BETWEEN 50 AND 100 THEN 1 ELSE 0 END) as good,
+            SUM(CASE WHEN total_score >= 0 AND total_score < 50 THEN 1 ELSE 0 END) as average,
+            SUM(CASE WHEN total_score >= -50 AND total_score < 0 THEN 1 ELSE 0 END) as poor,
+            SUM(CASE WHEN total_score < -50 THEN 1 ELSE 0 END) as terrible
+        FROM media_files
+        WHERE service_type = ? AND quality_profile_name IS NOT NULL
+        GROUP BY quality_profile_name
+    """
+    
+    # Usage of every custom format, from the normalized media_file_formats table
+    FORMAT_AGGREGATE_SQL = """
+        SELECT
+            f.format_name,
+            COUNT(*) as usage_count,
+            AVG(m.total_score) as avg_contribution,
+            COUNT(DISTINCT f.media_file_id) as files_with_format,
+            MIN(f.media_file_id) as first_file_id
+        FROM media_file_formats f
+        JOIN media_files m ON m.id = f.media_file_id
+        WHERE f.service_type = ?
+        GROUP BY f.format_name
+    """
+    
     def __init__(self, db_manager: DatabaseManager):
         self.db = db_manager
     
     def identify_upgrade_candidates(self, service_type: str, 
-                                  min_score_threshold: int = 50) -> List[UpgradeCandidate]:
+                                  min_score_threshold: int = 50, *,
+                                  stats: Optional[LibraryStats] = None,
+                                  top_k: Optional[int] = None) -> List[UpgradeCandidate]:
         """
         Intelligently identify files that are candidates for upgrade.
         
         Uses multiple criteria beyond just low scores to identify the best
-        upgrade candidates with highest impact potential.
+        upgrade candidates with highest impact potential. Pass the library's
+        stats if they were already calculated, to skip querying the averages.
+        With top_k, only the first top_k candidates are selected and returned.
         """
-        candidates = []
+        # Get library averages for context
+        if stats is not None:
+            avg_score, avg_file_size_gb = stats.avg_score, stats.avg_file_size_gb
+        else:
+            avg_score, avg_file_size_gb = self.db.get_score_and_size_averages(service_type)
         
-        # Get files with low scores
-        low_score_files = self.db.get_upgrade_candidates(min_score_threshold, service_type)
+        # Get files with low scores as raw rows, pre-filtered in SQL against the averages;
+        # only the ones that qualify become MediaFile objects
+        low_score_rows = self.db.get_upgrade_candidate_rows(
+            min_score_threshold, service_type,
+            avg_score=avg_score, avg_file_size_gb=avg_file_size_gb)
         
-        # Get library stats for context
-        stats = self.db.calculate_library_stats(service_type)
-        avg_score = stats.avg_score
+        candidates = self._iter_upgrade_candidates(low_score_rows, avg_score, avg_file_size_gb)
         
-        for file in low_score_files:
+        # Sort by worst score first (lowest/most negative scores first), then by priority
+        sort_key = lambda c: (c[0]['total_score'], c[3])
+        if top_k is not None:
+            selected = heapq.nsmallest(top_k, candidates, key=sort_key)  # Partial sort, O(N log K)
+        else:
+            selected = sorted(candidates, key=sort_key)
+        
+        # Only the selected candidates are converted to MediaFile objects
+        return [
+            UpgradeCandidate(
+                media_file=self.db._row_to_media_file(row, custom_formats),
+                reason=reason,
+                priority=priority,
+                potential_score_gain=potential_gain,
+                recommendation=recommendation
+            )
+            for row, custom_formats, reason, priority, potential_gain, recommendation in selected
+        ]
+    
+    def _iter_upgrade_candidates(self, low_score_rows: List[sqlite3.Row], avg_score: float,
+                                 avg_file_size_gb: float) -> Iterator[Tuple[Any, ...]]:
+        """
+        Lazily evaluate low-scoring rows as upgrade candidates.
+        
+        Yields (row, custom_formats, reason, priority, potential_gain, recommendation)
+        for each row that has at least one reason to upgrade.
+        """
+        # Loop invariants, looked up once instead of per row
+        parse_custom_formats = self.db._parse_custom_formats
+        check_size = avg_file_size_gb > 0
+        large_file_size_gb = avg_file_size_gb * 2
+        
+        for row in low_score_rows:
+            total_score = row['total_score']
+            size_bytes = row['size_bytes']
+            resolution = row['resolution']
+            custom_formats = parse_custom_formats(row['custom_formats_json'])
             reasons = []
             priority = 4  # default low priority
             potential_gain = None
             recommendation = None
             
             # Analyze score relative to library average
-            score_gap = avg_score - file.total_score
+            score_gap = avg_score - total_score
             if score_gap > 100:
                 reasons.append(f"Score {score_gap:.0f} points below library average")
                 priority = min(priority, 1)  # critical
@@ -118,78 +199,77 @@ class IntelligentAnalyzer:
                 reasons.append("Score below library average")
                 priority = min(priority, 3)  # medium
             
+            # Scan the formats once: count negative ones and find the worst
+            negative_count = 0
+            worst_format = None
+            for cf in custom_formats:
+                cf_score = cf.score
+                if cf_score < 0:
+                    negative_count += 1
+                    if worst_format is None or cf_score < worst_format.score:
+                        worst_format = cf
+            
             # Check for specific problematic formats
-            negative_formats = [cf for cf in file.custom_formats if cf.score < 0]
-            if negative_formats:
-                reasons.append(f"Has {len(negative_formats)} negative-scoring format(s)")
-                if any(cf.score < -50 for cf in negative_formats):
+            if negative_count:
+                reasons.append(f"Has {negative_count} negative-scoring format(s)")
+                if worst_format.score < -50:
                     priority = min(priority, 1)  # critical for very negative formats
-                elif any(cf.score < -20 for cf in negative_formats):
+                elif worst_format.score < -20:
                     priority = min(priority, 2)  # high
                     
                 # Generate specific recommendation
-                worst_format = min(negative_formats, key=lambda cf: cf.score)
                 recommendation = f"Replace release to avoid '{worst_format.name}' format (score: {worst_format.score})"
             
             # Check file size efficiency (if available)
-            if file.size_bytes and stats.avg_file_size_gb > 0:
-                file_size_gb = file.size_bytes / (1024**3)
-                if file_size_gb > stats.avg_file_size_gb * 2 and file.total_score < 0:
+            if size_bytes and check_size:
+                file_size_gb = size_bytes / (1024**3)
+                if file_size_gb > large_file_size_gb and total_score < 0:
                     reasons.append("Large file with poor quality score")
                     priority = min(priority, 2)
                     recommendation = "Consider replacing with higher quality, smaller release"
             
             # Check for missing beneficial formats
-            missing_hdr = not any("HDR" in cf.name.upper() for cf in file.custom_formats)
-            missing_dv = not any("DOLBY" in cf.name.upper() and "VISION" in cf.name.upper() 
-                               for cf in file.custom_formats)
-            
-            if file.resolution and "2160p" in file.resolution and missing_hdr:
+            if (resolution and "2160p" in resolution and
+                not row['format_flags'] & FormatFlags.HDR):
                 reasons.append("4K file missing HDR formats")
                 priority = min(priority, 3)
                 if not recommendation:
                     recommendation = "Look for HDR10 or Dolby Vision release"
             
             if reasons:
-                candidates.append(UpgradeCandidate(
-                    media_file=file,
-                    reason="; ".join(reasons),
-                    priority=priority,
-                    potential_score_gain=potential_gain,
-                    recommendation=recommendation
-                ))
+                yield row, custom_formats, "; ".join(reasons), priority, potential_gain, recommendation
+    
+    def analyze_quality_profiles(self, service_type: str, *,
+                                 stats: Optional[LibraryStats] = None) -> List[QualityProfileAnalysis]:
+        """Analyze effectiveness of quality profiles, reusing the library's stats if given."""
+        if stats is None:
+            stats = self.db.calculate_library_stats(service_type)
         
-        # Sort by worst score first (lowest/most negative scores first), then by priority
-        candidates.sort(key=lambda c: (c.media_file.total_score, c.priority))
+        return self._build_quality_profile_analyses(self._aggregate_quality_profiles(service_type), stats)
+    
+    def _aggregate_quality_profiles(self, service_type: str) -> List[Tuple[str, int, float, int, int, int, int, int]]:
+        """
+        Aggregate every quality profile in one grouped query.
         
-        return candidates
+        Returns (profile_name, file_count, avg_score, excellent, good, average, poor, terrible)
+        rows, largest profile first.
+        """
+        with self.db._get_connection() as conn:
+            return conn.execute(self.PROFILE_AGGREGATE_SQL + " ORDER BY file_count DESC, quality_profile_name",
+                                (service_type,)).fetchall()
     
-    def analyze_quality_profiles(self, service_type: str) -> List[QualityProfileAnalysis]:
-        """Analyze effectiveness of quality profiles."""
+    def _build_quality_profile_analyses(self, profile_rows: List[Tuple[str, int, float, int, int, int, int, int]],
+                                        stats: LibraryStats) -> List[QualityProfileAnalysis]:
+        """Turn aggregated profile rows into analyses, best average score first."""
         analyses = []
-        stats = self.db.calculate_library_stats(service_type)
-        
-        for profile_name, file_count in stats.quality_profiles.items():
-            if file_count == 0:
-                continue
-                
-            # Get files for this profile
-            with self.db._get_connection() as conn:
-                rows = conn.execute("""
-                    SELECT total_score FROM media_files 
-                    WHERE service_type = ? AND quality_profile_name = ?
-                """, (service_type, profile_name)).fetchall()
-            
-            scores = [row[0] for row in rows]
-            avg_score = statistics.mean(scores)
-            
+        for profile_name, file_count, avg_score, excellent, good, average, poor, terrible in profile_rows:
             # Score distribution
             distribution = {
-                "excellent (>100)": sum(1 for s in scores if s > 100),
-                "good (50-100)": sum(1 for s in scores if 50 <= s <= 100),
-                "average (0-50)": sum(1 for s in scores if 0 <= s < 50),
-                "poor (-50-0)": sum(1 for s in scores if -50 <= s < 0),
-                "terrible (<-50)": sum(1 for s in scores if s < -50)
+                "excellent (>100)": excellent,
+                "good (50-100)": good,
+                "average (0-50)": average,
+                "poor (-50-0)": poor,
+                "terrible (<-50)": terrible
             }
             
             # Identify issues and recommendations
@@ -227,42 +307,16 @@ class IntelligentAnalyzer:
         
         return sorted(analyses, key=lambda a: a.avg_score, reverse=True)
     
-    def analyze_custom_format_effectiveness(self, service_type: str) -> List[CustomFormatEffectiveness]:
-        """Analyze which custom formats are most/least effective."""
-        format_stats = defaultdict(lambda: {"count": 0, "total_score": 0, "files": set()})
-        
-        # Get all files and their formats
-        with self.db._get_connection() as conn:
-            rows = conn.execute("""
-                SELECT custom_formats_json, total_score, unique_identifier
-                FROM media_files WHERE service_type = ? AND custom_formats_json IS NOT NULL
-            """, (service_type,)).fetchall()
-        
-        for row in rows:
-            try:
-                import json
-                formats = json.loads(row[0])
-                file_score = row[1]
-                file_id = row[2]
-                
-                for cf in formats:
-                    name = cf.get("name", "Unknown")
-                    
-                    format_stats[name]["count"] += 1
-                    format_stats[name]["total_score"] += file_score  # Use file's total score
-                    format_stats[name]["files"].add(file_id)
-            except (json.JSONDecodeError, TypeError):
-                continue
-        
+    def analyze_custom_format_effectiveness(self, service_type: str, *,
+                                            top_k: Optional[int] = None) -> List[CustomFormatEffectiveness]:
+        """Analyze which custom formats are most/least effective, keeping only the top_k most effective if given."""
+        return self._build_format_effectiveness(self._aggregate_custom_formats(service_type), top_k)
+    
+    def _build_format_effectiveness(self, format_rows: List[Tuple[str, int, float, int]],
+                                    top_k: Optional[int] = None) -> List[CustomFormatEffectiveness]:
+        """Turn aggregated format rows into effectiveness entries, most effective first."""
         effectiveness_list = []
-        for format_name, stats in format_stats.items():
-            if stats["count"] == 0:
-                continue
-                
-            avg_contribution = stats["total_score"] / stats["count"]
-            usage_count = stats["count"]
-            files_with_format = len(stats["files"])
-            
+        for format_name, usage_count, avg_contribution, files_with_format in format_rows:
             # Determine impact rating
             if avg_contribution > 50:
                 impact = "high"
@@ -291,30 +345,64 @@ class IntelligentAnalyzer:
                 recommendations=recommendations
             ))
         
-        return sorted(effectiveness_list, key=lambda e: e.avg_score_contribution, reverse=True)
+        sort_key = lambda e: e.avg_score_contribution
+        if top_k is not None:
+            return heapq.nlargest(top_k, effectiveness_list, key=sort_key)  # Partial sort, O(N log K)
+        return sorted(effectiveness_list, key=sort_key, reverse=True)
+    
+    def _aggregate_custom_formats(self, service_type: str) -> List[Tuple[str, int, float, int]]:
+        """
+        Aggregate custom format usage in one grouped query over media_file_formats.
+        
+        Returns (format_name, usage_count, avg_file_score, files_with_format) rows, ordered
+        by the first file each format appears on.
+        """
+        with self.db._get_connection() as conn:
+            rows = conn.execute(self.FORMAT_AGGREGATE_SQL + " ORDER BY first_file_id", (service_type,))
+            return [row[:4] for row in rows]
+    
+    def _aggregate_profiles_and_formats(self, service_type: str) -> Tuple[List[Tuple[str, int, float, int, int, int, int, int]],
+                                                                          List[Tuple[str, int, float, int]]]:
+        """
+        Run the profile and custom format aggregations as one compound statement.
+        
+        Returns the same rows, in the same order, as _aggregate_quality_profiles and
+        _aggregate_custom_formats.
+        """
+        with self.db._get_connection() as conn:
+            rows = conn.execute(
+                "SELECT 'profile', * FROM (" + self.PROFILE_AGGREGATE_SQL + ")"
+                " UNION ALL "
+                "SELECT 'format', *, NULL, NULL, NULL FROM (" + self.FORMAT_AGGREGATE_SQL + ")",
+                (service_type, service_type)
+            ).fetchall()
+        
+        # Demultiplex the tagged rows; both lists are small (one row per profile or format)
+        profile_rows = [row[1:] for row in rows if row[0] == 'profile']
+        format_rows = [row[1:] for row in rows if row[0] == 'format']
+        profile_rows.sort(key=lambda r: (-r[1], r[0]))
+        format_rows.sort(key=lambda r: r[4])
+        return profile_rows, [row[:4] for row in format_rows]
     
-    def analyze_historical_trends(self, service_type: str, days: int = 90) -> Dict[str, Any]:
-        """Analyze historical trends and patterns in library health over time."""
-        trends = self.db.get_score_trends(days, service_type)
+    def analyze_historical_trends(self, service_type: str, days: int = 90, *,
+                                  buckets: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """
+        Analyze historical trends and patterns in library health over time.
         
-        # Group trends by time periods
-        from collections import defaultdict
-        import datetime
+        Callers that already fetched get_trend_buckets(days, service_type) can pass the
+        rows as buckets to avoid querying them again.
+        """
+        if buckets is None:
+            buckets = self.db.get_trend_buckets(days, service_type)
         
+        # Group trends by time periods; SQLite already counted them per week and month
         weekly_data = defaultdict(lambda: {'improvements': 0, 'degradations': 0})
         monthly_data = defaultdict(lambda: {'improvements': 0, 'degradations': 0})
         
-        for trend in trends:
-            timestamp = datetime.datetime.fromisoformat(trend['timestamp'])
-            week_key = timestamp.strftime('%Y-W%U')
-            month_key = timestamp.strftime('%Y-%m')
-            
-            if trend['change_type'] == 'improved':
-                weekly_data[week_key]['improvements'] += 1
-                monthly_data[month_key]['improvements'] += 1
-            elif trend['change_type'] == 'degraded':
-                weekly_data[week_key]['degradations'] += 1
-                monthly_data[month_key]['degradations'] += 1
+        for bucket in buckets:
+            key = 'improvements' if bucket['change_type'] == 'improved' else 'degradations'
+            weekly_data[bucket['week']][key] += bucket['count']
+            monthly_data[bucket['month']][key] += bucket['count']
         
         # Calculate velocity metrics
         recent_weeks = sorted(weekly_data.keys())[-4:]  # Last 4 weeks
@@ -353,116 +441,149 @@ class IntelligentAnalyzer:
             'net_velocity': improvement_velocity - degradation_velocity,
             'patterns': patterns,
             'recommendations': trend_recommendations,
-            'total_changes': len(trends)
+            'total_changes': sum(bucket['count'] for bucket in buckets)
         }
     
-    def categorize_files_intelligently(self, service_type: str) -> Dict[str, List[MediaFile]]:
-        """Intelligently categorize files based on patterns, scores, and metadata."""
-        # Get all files for the service
+    def categorize_files_intelligently(self, service_type: str, *,
+                                       stats: Optional[LibraryStats] = None) -> Dict[str, List[MediaFile]]:
+        """Intelligently categorize files based on patterns, scores, and metadata, reusing the library's stats if given."""
+        # Both queries below read the same snapshot, so the ids they see agree
+        with self.db.read_snapshot():
+            return self._categorize_files(service_type, stats)
+    
+    def _categorize_files(self, service_type: str, stats: Optional[LibraryStats]) -> Dict[str, List[MediaFile]]:
+        """Categorize files; see categorize_files_intelligently."""
+        # Categorize by id from just the columns the rules read; only files that end up
+        # in a category become MediaFile objects
         with self.db._get_connection() as conn:
-            conn.row_factory = sqlite3.Row
             rows = conn.execute("""
-                SELECT * FROM media_files 
+                SELECT id, total_score, size_bytes, resolution, quality, format_flags
+                FROM media_files 
                 WHERE service_type = ?
-                ORDER BY total_score DESC
+                ORDER BY total_score DESC, id
             """, (service_type,)).fetchall()
         
-        files = [self.db._row_to_media_file(row) for row in rows]
-        
+        # Each file lands only in its most specific category; the keys are in priority
+        # order and the checks below pick the first one that applies, in the same order
         categories = {
-            'premium_quality': [],      # High score, good formats
-            'acceptable_quality': [],   # Mid-range scores
-            'upgrade_worthy': [],       # Low scores but salvageable
             'priority_replacements': [], # Very poor quality
             'large_low_quality': [],    # Size/quality mismatch
-            'format_optimized': [],     # Good format usage
-            'legacy_content': [],       # Old/problematic formats
             'hdr_candidates': [],       # 4K files missing HDR
             'audio_upgrade_candidates': [], # Files with poor audio
-            'resolution_mismatches': []  # Quality/resolution issues
+            'legacy_content': [],       # Old/problematic formats
+            'resolution_mismatches': [], # Quality/resolution issues
+            'upgrade_worthy': [],       # Low scores but salvageable
+            'format_optimized': [],     # Good format usage
+            'premium_quality': [],      # High score, good formats
+            'acceptable_quality': []    # Mid-range scores
         }
         
-        stats = self.db.calculate_library_stats(service_type)
+        if stats is None:
+            stats = self.db.calculate_library_stats(service_type)
         avg_score = stats.avg_score
         
-        for file in files:
+        # Loop invariants, computed once instead of per row
+        premium_threshold = max(75, avg_score + 30)
+        acceptable_threshold = max(0, avg_score - 10)
+        upgrade_threshold = avg_score - 20
+        check_size = stats.avg_file_size_gb > 0
+        large_file_size_gb = stats.avg_file_size_gb * 1.5
+        hdr_flags = FormatFlags.HDR | FormatFlags.DOLBY_VISION
+        
+        assigned_files = set()
+        
+        for file_id, total_score, size_bytes, resolution, quality, format_flags in rows:
             # Premium quality: High scores with good formats
-            if file.total_score > max(75, avg_score + 30):
-                categories['premium_quality'].append(file)
+            if total_score > premium_threshold:
+                score_category = 'premium_quality'
             
             # Acceptable quality: Around average or better
-            elif file.total_score >= max(0, avg_score - 10):
-                categories['acceptable_quality'].append(file)
+            elif total_score >= acceptable_threshold:
+                score_category = 'acceptable_quality'
             
             # Priority replacements: Very poor scores
-            elif file.total_score < -50:
-                categories['priority_replacements'].append(file)
+            elif total_score < -50:
+                score_category = 'priority_replacements'
             
             # Upgrade worthy: Poor but not terrible
-            elif file.total_score < avg_score - 20:
-                categories['upgrade_worthy'].append(file)
+            elif total_score < upgrade_threshold:
+                score_category = 'upgrade_worthy'
             
-            # Size/quality analysis
-            if file.size_bytes and stats.avg_file_size_gb > 0:
-                file_size_gb = file.size_bytes / (1024**3)
-                if file_size_gb > stats.avg_file_size_gb * 1.5 and file.total_score < 0:
-                    categories['large_low_quality'].append(file)
+            else:
+                score_category = None
             
-            # Format analysis
-            format_names = [cf.name.upper() for cf in file.custom_formats]
+            if score_category == 'priority_replacements':
+                category = score_category
+            
+            # Size/quality analysis
+            elif (size_bytes and check_size and
+                  size_bytes / (1024**3) > large_file_size_gb and total_score < 0):
+                category = 'large_low_quality'
             
+            # Format analysis, from the keyword flags stored with the file
             # HDR candidates (4K without HDR)
-            if (file.resolution and "2160" in file.resolution and 
-                not any("HDR" in name or "DOLBY" in name for name in format_names)):
-                categories['hdr_candidates'].append(file)
+            elif (resolution and "2160" in resolution and 
+                  not format_flags & hdr_flags):
+                category = 'hdr_candidates'
             
             # Audio upgrade candidates
-            poor_audio_formats = ["AAC", "MP3", "OPUS"]
-            if any(audio in name for name in format_names for audio in poor_audio_formats):
-                categories['audio_upgrade_candidates'].append(file)
+            elif format_flags & FormatFlags.POOR_AUDIO:
+                category = 'audio_upgrade_candidates'
             
             # Legacy content detection
-            legacy_formats = ["XVID", "DIVX", "YIFY", "RARBG", "AXXO"]
-            if any(legacy in name for name in format_names for legacy in legacy_formats):
-                categories['legacy_content'].append(file)
+            elif format_flags & FormatFlags.LEGACY:
+                category = 'legacy_content'
+            
+            # Resolution mismatches
+            elif (resolution and quality and 
+                  (("1080p" in str(resolution) and "720p" in str(quality)) or
+                   ("2160p" in str(resolution) and "1080p" in str(quality)))):
+                category = 'resolution_mismatches'
+            
+            elif score_category == 'upgrade_worthy':
+                category = score_category
             
             # Format optimized (good format usage)
-            premium_formats = ["REMUX", "BLURAY", "UHD", "ATMOS", "DTS-HD", "TRUEHD"]
-            if (any(premium in name for name in format_names for premium in premium_formats) 
-                and file.total_score > 50):
-                categories['format_optimized'].append(file)
+            elif format_flags & FormatFlags.PREMIUM and total_score > 50:
+                category = 'format_optimized'
             
-            # Resolution mismatches
-            if (file.resolution and file.quality and 
-                (("1080p" in str(file.resolution) and "720p" in str(file.quality)) or
-                ("2160p" in str(file.resolution) and "1080p" in str(file.quality)))):
-                categories['resolution_mismatches'].append(file)
-        
-        # Remove files from multiple categories (prioritize more specific categories)
-        priority_order = [
-            'priority_replacements', 'large_low_quality', 'hdr_candidates',
-            'audio_upgrade_candidates', 'legacy_content', 'resolution_mismatches',
-            'upgrade_worthy', 'format_optimized', 'premium_quality', 'acceptable_quality'
-        ]
-        
-        assigned_files = set()
-        cleaned_categories = {}
+            # Premium or acceptable quality, if the score put the file in either
+            else:
+                category = score_category
+            
+            if category is not None:
+                categories[category].append(file_id)
+                assigned_files.add(file_id)
         
-        for category in priority_order:
-            cleaned_categories[category] = [
-                f for f in categories[category] 
-                if f.unique_identifier not in assigned_files
-            ]
-            assigned_files.update(f.unique_identifier for f in cleaned_categories[category])
+        # Convert the assigned files, streaming the full rows instead of holding them all
+        media_files = {}
+        with self.db._get_connection() as conn:
+            conn.row_factory = sqlite3.Row
+            for row in conn.execute("SELECT * FROM media_files WHERE service_type = ?", (service_type,)):
+                if row['id'] in assigned_files:
+                    media_files[row['id']] = self.db._row_to_media_file(row)
         
-        return cleaned_categories
+        return {
+            category: [media_files[file_id] for file_id in category_ids]
+            for category, category_ids in categories.items()
+        }
     
     def generate_library_health_report(self, service_type: str, min_score_threshold: int = 50) -> LibraryHealthReport:
         """Generate comprehensive library health report."""
+        # Every query of the report reads one consistent snapshot over a single connection
+        with self.db.read_snapshot():
+            return self._generate_library_health_report(service_type, min_score_threshold)
+    
+    def _generate_library_health_report(self, service_type: str, min_score_threshold: int) -> LibraryHealthReport:
+        """Build the health report; see generate_library_health_report."""
+        # Calculated once and shared by every analysis below
         stats = self.db.calculate_library_stats(service_type)
-        candidates = self.identify_upgrade_candidates(service_type, min_score_threshold)
-        profile_analysis = self.analyze_quality_profiles(service_type)
-        format_effectiveness = self.analyze_custom_format_effectiveness(service_type)
+        candidates = self.identify_upgrade_candidates(service_type, min_score_threshold, stats=stats)
+        
+        # Profile and format aggregates come back from a single statement
+        profile_rows, format_rows = self._aggregate_profiles_and_formats(service_type)
+        profile_analysis = self._build_quality_profile_analyses(profile_rows, stats)
+        format_effectiveness = self._build_format_effectiveness(format_rows, top_k=15)  # Top 15 formats
         
         # Calculate health score (0-100)
         health_factors = []
@@ -485,7 +606,7 @@ class IntelligentAnalyzer:
         upgrade_ratio = len(candidates) / max(stats.total_files, 1)
         health_factors.append(max(0, 100 - (upgrade_ratio * 200)))
         
-        health_score = statistics.mean(health_factors)
+        health_score = sum(health_factors) / len(health_factors)
         
         # Health grade
         if health_score >= 90:
@@ -521,15 +642,21 @@ class IntelligentAnalyzer:
             warnings.append(f"{len(critical_candidates)} files need immediate attention")
             recommendations.append("Prioritize upgrading critical files with very low scores")
         
-        # Get score trends
-        trends = self.db.get_score_trends(30, service_type)
-        improvements = [t for t in trends if t['change_type'] == 'improved']
-        degradations = [t for t in trends if t['change_type'] == 'degraded']
+        # Get score trends: one 90-day bucket query serves both the 30-day counts
+        # and the historical analysis
+        trend_buckets = self.db.get_trend_buckets(90, service_type, recent_days=30)
+        improvements = degradations = 0
+        for bucket in trend_buckets:
+            if bucket['recent']:
+                if bucket['change_type'] == 'improved':
+                    improvements += bucket['count']
+                else:
+                    degradations += bucket['count']
         
         score_trends = {
-            "improvements_last_30_days": len(improvements),
-            "degradations_last_30_days": len(degradations),
-            "net_change": len(improvements) - len(degradations)
+            "improvements_last_30_days": improvements,
+            "degradations_last_30_days": degradations,
+            "net_change": improvements - degradations
         }
         
         if score_trends["net_change"] > 0:
@@ -539,8 +666,8 @@ class IntelligentAnalyzer:
             recommendations.append("Investigate why scores are degrading")
         
         # Phase 2: Generate enhanced analytics
-        historical_analysis = self.analyze_historical_trends(service_type)
-        intelligent_categories = self.categorize_files_intelligently(service_type)
+        historical_analysis = self.analyze_historical_trends(service_type, 90, buckets=trend_buckets)
+        intelligent_categories = self.categorize_files_intelligently(service_type, stats=stats)
         
         # Add insights from historical analysis
         if historical_analysis['patterns']:
@@ -571,7 +698,7 @@ class IntelligentAnalyzer:
             total_files=stats.total_files,
             upgrade_candidates=candidates,  # All candidates (pagination handled in UI)
             quality_profile_analysis=profile_analysis,
-            format_effectiveness=format_effectiveness[:15],  # Top 15 formats
+            format_effectiveness=format_effectiveness,
             score_trends=score_trends,
             recommendations=recommendations,
             achievements=achievements,
@@ -550,6 +550,22 @@ def _create_limited_database(source_db: DatabaseManager, service: str, limit: in
             VALUES ({placeholders})
         """, files)
         
+        # Copy the normalized custom formats of those files as well,
+        # in chunks since older SQLite builds allow at most 999 parameters per statement
+        id_index = columns.index('id')
+        file_ids = [file_row[id_index] for file_row in files]
+        for start in range(0, len(file_ids), 500):
+            chunk = file_ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            format_rows = source_conn.execute(f"""
+                SELECT media_file_id, service_type, format_name, format_score
+                FROM media_file_formats WHERE media_file_id IN ({placeholders})
+            """, chunk).fetchall()
+            temp_conn.executemany("""
+                INSERT INTO media_file_formats (media_file_id, service_type, format_name, format_score)
+                VALUES (?, ?, ?, ?)
+            """, format_rows)
+        
         temp_conn.commit()
         
     finally:
@@ -6,6 +6,7 @@ from .database import (
     ScoreHistory,
     LibraryStats,
     ScoreChangeType,
+    FormatFlags,
     DatabaseManager
 )
 
@@ -15,5 +16,6 @@ __all__ = [
     'ScoreHistory',
     'LibraryStats',
     'ScoreChangeType',
+    'FormatFlags',
     'DatabaseManager'
 ]
\ No newline at end of file
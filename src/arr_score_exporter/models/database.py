@@ -9,11 +9,15 @@ import sqlite3
 import datetime
 import threading
 import time
+from collections import Counter
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Any
 from dataclasses import dataclass, field
 from enum import Enum
+from functools import lru_cache
 import json
+import re
 
 
 class ScoreChangeType(Enum):
@@ -25,6 +29,49 @@ class ScoreChangeType(Enum):
     UNCHANGED = "unchanged"
 
 
+class FormatFlags:
+    """Bit flags stored in media_files.format_flags, derived from a file's custom format names."""
+    HDR = 1
+    DOLBY_VISION = 2
+    POOR_AUDIO = 4
+    LEGACY = 8
+    PREMIUM = 16
+    
+    # Upper-case keywords that set each flag when they appear in a format name
+    KEYWORDS = (
+        (HDR, ("HDR",)),
+        (DOLBY_VISION, ("DOLBY",)),
+        (POOR_AUDIO, ("AAC", "MP3", "OPUS")),
+        (LEGACY, ("XVID", "DIVX", "YIFY", "RARBG", "AXXO")),
+        (PREMIUM, ("REMUX", "BLURAY", "UHD", "ATMOS", "DTS-HD", "TRUEHD")),
+    )
+    
+    @staticmethod
+    def for_names(names_upper) -> int:
+        """Combine the flags of a file's upper-cased custom format names."""
+        flags = 0
+        for name_upper in names_upper:
+            flags |= _format_name_flags(name_upper)
+        return flags
+
+
+# One precompiled alternation per flag, so a name is scanned once per flag rather than once per keyword
+_FORMAT_FLAG_PATTERNS = tuple(
+    (flag, re.compile("|".join(re.escape(keyword) for keyword in keywords)))
+    for flag, keywords in FormatFlags.KEYWORDS
+)
+
+
+@lru_cache(maxsize=1024)
+def _format_name_flags(name_upper: str) -> int:
+    """Flags set by one upper-cased format name; the vocabulary is small, so results are cached."""
+    flags = 0
+    for flag, pattern in _FORMAT_FLAG_PATTERNS:
+        if pattern.search(name_upper):
+            flags |= flag
+    return flags
+
+
 @dataclass
 class CustomFormatDetail:
     """Detailed custom format information."""
@@ -33,6 +80,22 @@ class CustomFormatDetail:
     format_id: int
     category: Optional[str] = None
     tags: List[str] = field(default_factory=list)
+    
+    # Upper-cased name for case-insensitive matching, computed once instead of per check
+    name_upper: str = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        self.name_upper = self.name.upper()
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert to dictionary for JSON serialization."""
+        return {
+            'name': self.name,
+            'score': self.score,
+            'format_id': self.format_id,
+            'category': self.category,
+            'tags': self.tags
+        }
 
 
 @dataclass
@@ -160,9 +223,35 @@ class LibraryStats:
     codec_distribution: Dict[str, int]
 
 
+class _SnapshotConnection:
+    """
+    Connection handed out by DatabaseManager._get_connection() inside read_snapshot().
+    
+    Used as a context manager it gives the shared connection with its default row
+    factory, and leaves the snapshot's read transaction open on exit instead of
+    committing it.
+    """
+    
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+    
+    def __enter__(self) -> sqlite3.Connection:
+        self._conn.row_factory = None
+        return self._conn
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
 class DatabaseManager:
     """Enhanced database manager with historical tracking and analytics."""
     
+    # Bumped whenever existing databases need a migration step in _init_database
+    SCHEMA_VERSION = 3
+    
     def __init__(self, db_path: Optional[Path] = None):
         """Initialize database manager."""
         if db_path is None:
@@ -171,16 +260,48 @@ class DatabaseManager:
         self.db_path = db_path
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
         self._lock = threading.Lock()
+        self._local = threading.local()  # Per-thread read snapshot, see read_snapshot()
         self._init_database()
     
     def _get_connection(self):
         """Get a database connection with proper settings for concurrency."""
-        conn = sqlite3.connect(self.db_path, timeout=30.0)
+        snapshot = getattr(self._local, 'snapshot', None)
+        if snapshot is not None:
+            return snapshot
+        
+        conn = sqlite3.connect(self.db_path, timeout=30.0, cached_statements=256)
         conn.execute("PRAGMA busy_timeout = 30000")  # 30 second timeout
         conn.execute("PRAGMA journal_mode = WAL")     # Write-Ahead Logging for better concurrency
         conn.execute("PRAGMA synchronous = NORMAL")   # Balance between safety and performance
+        conn.execute("PRAGMA cache_size = -64000")    # 64 MB page cache for the aggregation queries
+        conn.execute("PRAGMA temp_store = MEMORY")    # Keep GROUP BY/ORDER BY temp b-trees off disk
         return conn
     
+    @contextmanager
+    def read_snapshot(self):
+        """
+        Serve every _get_connection() call on this thread from one read-only connection.
+        
+        The queries share a single read transaction, so a report built from many queries
+        sees one consistent state of the library, and reuses one warm page cache and
+        statement cache instead of opening a connection per query.
+        """
+        if getattr(self._local, 'snapshot', None) is not None:
+            yield  # Already inside a snapshot on this thread
+            return
+        
+        conn = self._get_connection()
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute("PRAGMA mmap_size = 268435456")  # Map up to 256 MB of the file for reads
+        conn.execute("BEGIN")
+        self._local.snapshot = _SnapshotConnection(conn)
+        try:
+            yield
+        finally:
+            self._local.snapshot = None
+            conn.rollback()  # Nothing was written; just end the read transaction
+            conn.close()
+    
     def _init_database(self):
         """Initialize database schema."""
         with self._lock:
@@ -195,6 +316,7 @@ class DatabaseManager:
                     title TEXT NOT NULL,
                     total_score INTEGER NOT NULL,
                     custom_formats_json TEXT,
+                    format_flags INTEGER NOT NULL DEFAULT 0,  -- FormatFlags bits
                     quality_profile_id INTEGER,
                     quality_profile_name TEXT,
                     quality TEXT,
@@ -227,6 +349,22 @@ class DatabaseManager:
                     FOREIGN KEY (unique_identifier) REFERENCES media_files (unique_identifier)
                 );
                 
+                -- Custom formats of each media file, normalized so they can be aggregated without JSON parsing
+                CREATE TABLE IF NOT EXISTS media_file_formats (
+                    media_file_id INTEGER NOT NULL,
+                    service_type TEXT NOT NULL,
+                    format_name TEXT NOT NULL,
+                    format_score INTEGER,
+                    FOREIGN KEY (media_file_id) REFERENCES media_files (id)
+                );
+                
+                -- Drop a file's custom formats along with it, whichever code path deletes the file
+                CREATE TRIGGER IF NOT EXISTS trg_media_files_delete_formats
+                AFTER DELETE ON media_files
+                BEGIN
+                    DELETE FROM media_file_formats WHERE media_file_id = OLD.id;
+                END;
+                
                 -- Library statistics snapshots
                 CREATE TABLE IF NOT EXISTS library_stats (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -266,11 +404,76 @@ class DatabaseManager:
                 CREATE INDEX IF NOT EXISTS idx_media_files_service_type ON media_files (service_type);
                 CREATE INDEX IF NOT EXISTS idx_media_files_recorded_at ON media_files (recorded_at);
                 CREATE INDEX IF NOT EXISTS idx_media_files_total_score ON media_files (total_score);
+                CREATE INDEX IF NOT EXISTS idx_media_files_service_profile_score ON media_files (service_type, quality_profile_name, total_score);
+                CREATE INDEX IF NOT EXISTS idx_media_files_service_score ON media_files (service_type, total_score);
+                CREATE INDEX IF NOT EXISTS idx_media_file_formats_file ON media_file_formats (media_file_id);
+                CREATE INDEX IF NOT EXISTS idx_media_file_formats_service_name ON media_file_formats (service_type, format_name, media_file_id);
                 CREATE INDEX IF NOT EXISTS idx_score_history_timestamp ON score_history (timestamp);
-                CREATE INDEX IF NOT EXISTS idx_score_history_change_type ON score_history (change_type);
+                CREATE INDEX IF NOT EXISTS idx_score_history_change_timestamp ON score_history (change_type, timestamp, unique_identifier);
                 CREATE INDEX IF NOT EXISTS idx_library_stats_timestamp ON library_stats (timestamp);
                 CREATE INDEX IF NOT EXISTS idx_export_runs_timestamp ON export_runs (timestamp);
             """)
+                
+                user_version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if user_version < 1:
+                    # Databases created before media_file_formats existed only have the JSON column
+                    self._backfill_media_file_formats(conn)
+                if user_version < 2:
+                    # Databases created before format_flags existed lack the column
+                    self._backfill_format_flags(conn)
+                if user_version < 3:
+                    # idx_score_history_change_timestamp leads with change_type and covers it
+                    conn.execute("DROP INDEX IF EXISTS idx_score_history_change_type")
+                if user_version < self.SCHEMA_VERSION:
+                    conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+    
+    def _backfill_media_file_formats(self, conn):
+        """Populate media_file_formats from the custom_formats_json of every stored file."""
+        format_rows = []
+        rows = conn.execute(
+            "SELECT id, service_type, custom_formats_json FROM media_files WHERE custom_formats_json IS NOT NULL"
+        )
+        for media_file_id, service_type, custom_formats_json in rows:
+            try:
+                formats_data = json.loads(custom_formats_json)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(formats_data, list):
+                continue
+            
+            for cf in formats_data:
+                if isinstance(cf, dict):
+                    name = cf.get('name')
+                    format_rows.append((media_file_id, service_type,
+                                        name if name is not None else 'Unknown', cf.get('score')))
+        
+        conn.executemany("""
+            INSERT INTO media_file_formats (media_file_id, service_type, format_name, format_score)
+            VALUES (?, ?, ?, ?)
+        """, format_rows)
+    
+    def _backfill_format_flags(self, conn):
+        """Add media_files.format_flags if missing and compute it from media_file_formats."""
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(media_files)")]
+        if 'format_flags' not in columns:
+            conn.execute("ALTER TABLE media_files ADD COLUMN format_flags INTEGER NOT NULL DEFAULT 0")
+        
+        file_flags: Dict[int, int] = {}
+        for media_file_id, format_name in conn.execute("SELECT media_file_id, format_name FROM media_file_formats"):
+            file_flags[media_file_id] = file_flags.get(media_file_id, 0) | _format_name_flags(format_name.upper())
+        
+        conn.executemany(
+            "UPDATE media_files SET format_flags = ? WHERE id = ?",
+            [(flags, media_file_id) for media_file_id, flags in file_flags.items() if flags]
+        )
+    
+    def _store_media_file_formats(self, conn, media_file_id: int, media_file: MediaFile):
+        """Replace the normalized custom format rows of a stored media file."""
+        conn.execute("DELETE FROM media_file_formats WHERE media_file_id = ?", (media_file_id,))
+        conn.executemany("""
+            INSERT INTO media_file_formats (media_file_id, service_type, format_name, format_score)
+            VALUES (?, ?, ?, ?)
+        """, [(media_file_id, media_file.service_type, cf.name, cf.score) for cf in media_file.custom_formats])
     
     def store_media_file(self, media_file: MediaFile) -> bool:
         """Store or update a media file record."""
@@ -286,21 +489,22 @@ class DatabaseManager:
                         
                         # Check if file already exists
                         existing = conn.execute(
-                            "SELECT total_score FROM media_files WHERE unique_identifier = ?",
+                            "SELECT id, total_score FROM media_files WHERE unique_identifier = ?",
                             (media_file.unique_identifier,)
                         ).fetchone()
                         
-                        custom_formats_json = json.dumps([cf.__dict__ for cf in media_file.custom_formats])
+                        custom_formats_json = json.dumps([cf.to_dict() for cf in media_file.custom_formats])
+                        format_flags = FormatFlags.for_names(cf.name_upper for cf in media_file.custom_formats)
                         
                         if existing:
                             # Update existing record
-                            previous_score = existing[0]
+                            media_file_id, previous_score = existing
                             change_type = self._determine_change_type(previous_score, media_file.total_score)
                             
                             conn.execute("""
                                 UPDATE media_files SET
                                     file_id = ?, relative_path = ?, title = ?, total_score = ?,
-                                    custom_formats_json = ?, quality_profile_id = ?, quality_profile_name = ?,
+                                    custom_formats_json = ?, format_flags = ?, quality_profile_id = ?, quality_profile_name = ?,
                                     quality = ?, codec = ?, resolution = ?, size_bytes = ?,
                                     recorded_at = ?, file_modified_at = ?, service_type = ?,
                                     movie_id = ?, imdb_id = ?, tmdb_id = ?, series_id = ?,
@@ -308,7 +512,7 @@ class DatabaseManager:
                                 WHERE unique_identifier = ?
                             """, (
                                 media_file.file_id, media_file.relative_path, media_file.title,
-                                media_file.total_score, custom_formats_json, media_file.quality_profile_id,
+                                media_file.total_score, custom_formats_json, format_flags, media_file.quality_profile_id,
                                 media_file.quality_profile_name, media_file.quality, media_file.codec,
                                 media_file.resolution, media_file.size_bytes, media_file.recorded_at,
                                 media_file.file_modified_at, media_file.service_type, media_file.movie_id,
@@ -325,17 +529,17 @@ class DatabaseManager:
                                 )
                         else:
                             # Insert new record
-                            conn.execute("""
+                            cursor = conn.execute("""
                                 INSERT INTO media_files (
                                     unique_identifier, file_id, relative_path, title, total_score,
-                                    custom_formats_json, quality_profile_id, quality_profile_name,
+                                    custom_formats_json, format_flags, quality_profile_id, quality_profile_name,
                                     quality, codec, resolution, size_bytes, recorded_at, file_modified_at,
                                     service_type, movie_id, imdb_id, tmdb_id, series_id,
                                     season_number, episode_number, episode_title, tvdb_id
-                                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                             """, (
                                 media_file.unique_identifier, media_file.file_id, media_file.relative_path,
-                                media_file.title, media_file.total_score, custom_formats_json,
+                                media_file.title, media_file.total_score, custom_formats_json, format_flags,
                                 media_file.quality_profile_id, media_file.quality_profile_name,
                                 media_file.quality, media_file.codec, media_file.resolution,
                                 media_file.size_bytes, media_file.recorded_at, media_file.file_modified_at,
@@ -343,6 +547,7 @@ class DatabaseManager:
                                 media_file.tmdb_id, media_file.series_id, media_file.season_number,
                                 media_file.episode_number, media_file.episode_title, media_file.tvdb_id
                             ))
+                            media_file_id = cursor.lastrowid
                             
                             # Record as new file in history
                             self._record_score_history(
@@ -350,6 +555,8 @@ class DatabaseManager:
                                 None, ScoreChangeType.NEW_FILE, custom_formats_json
                             )
                         
+                        self._store_media_file_formats(conn, media_file_id, media_file)
+                        
                         return True
                         
             except sqlite3.OperationalError as e:
@@ -388,21 +595,22 @@ class DatabaseManager:
                                 
                                 # Check if file already exists
                                 existing = conn.execute(
-                                    "SELECT total_score FROM media_files WHERE unique_identifier = ?",
+                                    "SELECT id, total_score FROM media_files WHERE unique_identifier = ?",
                                     (media_file.unique_identifier,)
                                 ).fetchone()
                                 
-                                custom_formats_json = json.dumps([cf.__dict__ for cf in media_file.custom_formats])
+                                custom_formats_json = json.dumps([cf.to_dict() for cf in media_file.custom_formats])
+                                format_flags = FormatFlags.for_names(cf.name_upper for cf in media_file.custom_formats)
                                 
                                 if existing:
                                     # Update existing record
-                                    previous_score = existing[0]
+                                    media_file_id, previous_score = existing
                                     change_type = self._determine_change_type(previous_score, media_file.total_score)
                                     
                                     conn.execute("""
                                         UPDATE media_files SET
                                             file_id = ?, relative_path = ?, title = ?, total_score = ?,
-                                            custom_formats_json = ?, quality_profile_id = ?, quality_profile_name = ?,
+                                            custom_formats_json = ?, format_flags = ?, quality_profile_id = ?, quality_profile_name = ?,
                                             quality = ?, codec = ?, resolution = ?, size_bytes = ?,
                                             recorded_at = ?, file_modified_at = ?, service_type = ?,
                                             movie_id = ?, imdb_id = ?, tmdb_id = ?, series_id = ?,
@@ -410,7 +618,7 @@ class DatabaseManager:
                                         WHERE unique_identifier = ?
                                     """, (
                                         media_file.file_id, media_file.relative_path, media_file.title,
-                                        media_file.total_score, custom_formats_json, media_file.quality_profile_id,
+                                        media_file.total_score, custom_formats_json, format_flags, media_file.quality_profile_id,
                                         media_file.quality_profile_name, media_file.quality, media_file.codec,
                                         media_file.resolution, media_file.size_bytes, media_file.recorded_at,
                                         media_file.file_modified_at, media_file.service_type, media_file.movie_id,
@@ -427,17 +635,17 @@ class DatabaseManager:
                                         )
                                 else:
                                     # Insert new record
-                                    conn.execute("""
+                                    cursor = conn.execute("""
                                         INSERT INTO media_files (
                                             unique_identifier, file_id, relative_path, title, total_score,
-                                            custom_formats_json, quality_profile_id, quality_profile_name,
+                                            custom_formats_json, format_flags, quality_profile_id, quality_profile_name,
                                             quality, codec, resolution, size_bytes, recorded_at, file_modified_at,
                                             service_type, movie_id, imdb_id, tmdb_id, series_id,
                                             season_number, episode_number, episode_title, tvdb_id
-                                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                                     """, (
                                         media_file.unique_identifier, media_file.file_id, media_file.relative_path,
-                                        media_file.title, media_file.total_score, custom_formats_json,
+                                        media_file.title, media_file.total_score, custom_formats_json, format_flags,
                                         media_file.quality_profile_id, media_file.quality_profile_name,
                                         media_file.quality, media_file.codec, media_file.resolution,
                                         media_file.size_bytes, media_file.recorded_at, media_file.file_modified_at,
@@ -445,6 +653,7 @@ class DatabaseManager:
                                         media_file.tmdb_id, media_file.series_id, media_file.season_number,
                                         media_file.episode_number, media_file.episode_title, media_file.tvdb_id
                                     ))
+                                    media_file_id = cursor.lastrowid
                                     
                                     # Record as new file in history
                                     self._record_score_history(
@@ -452,6 +661,7 @@ class DatabaseManager:
                                         None, ScoreChangeType.NEW_FILE, custom_formats_json
                                     )
                                 
+                                self._store_media_file_formats(conn, media_file_id, media_file)
                                 processed += 1
                                 
                             except Exception as e:
@@ -564,8 +774,24 @@ class DatabaseManager:
     
     def get_upgrade_candidates(self, min_score: int = 50, service_type: Optional[str] = None) -> List[MediaFile]:
         """Get files that are candidates for upgrade based on low scores."""
+        rows = self.get_upgrade_candidate_rows(min_score, service_type)
+        return [self._row_to_media_file(row) for row in rows]
+    
+    def get_upgrade_candidate_rows(self, min_score: int = 50, service_type: Optional[str] = None, *,
+                                   avg_score: Optional[float] = None,
+                                   avg_file_size_gb: float = 0) -> List[sqlite3.Row]:
+        """
+        Get the raw rows of files that are candidates for upgrade based on low scores.
+        
+        Same selection and order as get_upgrade_candidates, but leaves converting rows
+        with _row_to_media_file to the caller, for the rows it actually keeps.
+        
+        Given the library averages, rows are also pre-filtered in SQL to those the
+        analyzer could flag: a score more than 20 below average, a negative-scoring
+        format, a large file with a negative score, or a 4K file without HDR.
+        """
         query = """
-            SELECT * FROM media_files
+            SELECT * FROM media_files m
             WHERE total_score <= ?
         """
         params = [min_score]
@@ -574,13 +800,40 @@ class DatabaseManager:
             query += " AND service_type = ?"
             params.append(service_type)
         
-        query += " ORDER BY total_score ASC, title ASC"
+        if avg_score is not None:
+            query += """
+                AND (? - total_score > 20
+                     OR EXISTS (SELECT 1 FROM media_file_formats f
+                                WHERE f.media_file_id = m.id AND f.format_score < 0)
+                     OR (instr(resolution, '2160p') > 0 AND format_flags & {hdr} = 0)
+            """.format(hdr=FormatFlags.HDR)
+            params.append(avg_score)
+            if avg_file_size_gb > 0:
+                query += " OR (total_score < 0 AND size_bytes / 1073741824.0 > ? * 2)"
+                params.append(avg_file_size_gb)
+            query += ")"
+        
+        query += " ORDER BY total_score ASC, title ASC, id"
         
         with self._get_connection() as conn:
             conn.row_factory = sqlite3.Row
-            rows = conn.execute(query, params).fetchall()
+            return conn.execute(query, params).fetchall()
+    
+    def get_score_and_size_averages(self, service_type: str) -> Tuple[float, float]:
+        """
+        Get the average score and average file size in GB of a library.
         
-        return [self._row_to_media_file(row) for row in rows]
+        Matches avg_score and avg_file_size_gb of calculate_library_stats without
+        running its distribution and median queries.
+        """
+        with self._get_connection() as conn:
+            avg_score, total_bytes, total_files = conn.execute("""
+                SELECT AVG(total_score), SUM(size_bytes), COUNT(*)
+                FROM media_files
+                WHERE service_type = ?
+            """, (service_type,)).fetchone()
+        
+        return avg_score or 0, ((total_bytes or 0) / (1024**3)) / max(total_files, 1)
     
     def get_files_with_size_data(self, service_type: Optional[str] = None, limit: int = 100) -> List[MediaFile]:
         """Get files that have size data for scatter plot visualization."""
@@ -594,7 +847,7 @@ class DatabaseManager:
             query += " AND service_type = ?"
             params.append(service_type)
         
-        query += " ORDER BY total_score DESC, size_bytes DESC LIMIT ?"
+        query += " ORDER BY total_score DESC, size_bytes DESC, id LIMIT ?"
         params.append(limit)
         
         with self._get_connection() as conn:
@@ -626,51 +879,67 @@ class DatabaseManager:
         
         return [dict(row) for row in rows]
     
+    def get_trend_buckets(self, days: int = 90, service_type: Optional[str] = None,
+                          recent_days: int = 30) -> List[Dict[str, Any]]:
+        """
+        Count improved/degraded score changes per week, month and change type in SQL.
+        
+        Weeks use the same '%Y-W%U' keys (Sunday as first day of the week) that
+        datetime.strftime produces; %U is computed from %j and %w because older SQLite
+        versions don't support it. Each row also says whether its changes fall within
+        the last recent_days, so callers can derive short-window counts from the same
+        result. Rows come back newest bucket first.
+        """
+        query = """
+            SELECT
+                strftime('%Y', h.timestamp) || '-W' || printf('%02d',
+                    (CAST(strftime('%j', h.timestamp) AS INTEGER) + 6
+                     - CAST(strftime('%w', h.timestamp) AS INTEGER)) / 7) as week,
+                strftime('%Y-%m', h.timestamp) as month,
+                h.change_type,
+                h.timestamp >= datetime('now', '-{} days') as recent,
+                COUNT(*) as count
+            FROM score_history h
+            JOIN media_files m ON h.unique_identifier = m.unique_identifier
+            WHERE h.timestamp >= datetime('now', '-{} days')
+            AND h.change_type IN ('improved', 'degraded')
+        """.format(recent_days, days)
+        
+        params = []
+        if service_type:
+            query += " AND m.service_type = ?"
+            params.append(service_type)
+        
+        query += " GROUP BY week, month, h.change_type, recent ORDER BY week DESC, month DESC"
+        
+        with self._get_connection() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(query, params).fetchall()
+        
+        return [dict(row) for row in rows]
+    
     def calculate_library_stats(self, service_type: str) -> LibraryStats:
         """Calculate comprehensive library statistics."""
         with self._get_connection() as conn:
             conn.row_factory = sqlite3.Row
             
-            # Basic counts and score statistics
-            stats_row = conn.execute("""
+            # Score counts and the profile, resolution and codec distributions in one scan;
+            # the library totals are folded from the (few) groups below
+            group_rows = conn.execute("""
                 SELECT 
-                    COUNT(*) as total_files,
+                    quality_profile_name,
+                    resolution,
+                    codec,
+                    COUNT(*) as count,
                     SUM(CASE WHEN total_score > 0 THEN 1 ELSE 0 END) as positive_scores,
                     SUM(CASE WHEN total_score < 0 THEN 1 ELSE 0 END) as negative_scores,
-                    SUM(CASE WHEN total_score = 0 THEN 1 ELSE 0 END) as zero_scores,
                     MIN(total_score) as min_score,
                     MAX(total_score) as max_score,
-                    AVG(total_score) as avg_score,
+                    SUM(total_score) as score_sum,
                     SUM(size_bytes) as total_bytes
                 FROM media_files
                 WHERE service_type = ?
-            """, (service_type,)).fetchone()
-            
-            # Quality profile distribution
-            profile_rows = conn.execute("""
-                SELECT quality_profile_name, COUNT(*) as count
-                FROM media_files
-                WHERE service_type = ? AND quality_profile_name IS NOT NULL
-                GROUP BY quality_profile_name
-                ORDER BY count DESC
-            """, (service_type,)).fetchall()
-            
-            # Resolution distribution
-            resolution_rows = conn.execute("""
-                SELECT resolution, COUNT(*) as count
-                FROM media_files
-                WHERE service_type = ? AND resolution IS NOT NULL
-                GROUP BY resolution
-                ORDER BY count DESC
-            """, (service_type,)).fetchall()
-            
-            # Codec distribution
-            codec_rows = conn.execute("""
-                SELECT codec, COUNT(*) as count
-                FROM media_files
-                WHERE service_type = ? AND codec IS NOT NULL
-                GROUP BY codec
-                ORDER BY count DESC
+                GROUP BY quality_profile_name, resolution, codec
             """, (service_type,)).fetchall()
             
             # Median score calculation
@@ -686,32 +955,53 @@ class DatabaseManager:
             """, (service_type,)).fetchall()
             
             median_score = sum(row[0] for row in median_row) / len(median_row) if median_row else 0
-            
+        
+        total_files = positive_scores = negative_scores = score_sum = total_bytes = 0
+        profiles = Counter()
+        resolutions = Counter()
+        codecs = Counter()
+        for row in group_rows:
+            count = row['count']
+            total_files += count
+            positive_scores += row['positive_scores']
+            negative_scores += row['negative_scores']
+            score_sum += row['score_sum']
+            total_bytes += row['total_bytes'] or 0
+            if row['quality_profile_name'] is not None:
+                profiles[row['quality_profile_name']] += count
+            if row['resolution'] is not None:
+                resolutions[row['resolution']] += count
+            if row['codec'] is not None:
+                codecs[row['codec']] += count
+        
+        # Most files first, ties by name like the former ORDER BY count DESC over named groups
+        by_count = lambda counts: dict(sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+        
         return LibraryStats(
             timestamp=datetime.datetime.now(),
             service_type=service_type,
-            total_files=stats_row['total_files'],
-            files_with_positive_scores=stats_row['positive_scores'],
-            files_with_negative_scores=stats_row['negative_scores'],
-            files_with_zero_scores=stats_row['zero_scores'],
-            min_score=stats_row['min_score'] or 0,
-            max_score=stats_row['max_score'] or 0,
-            avg_score=stats_row['avg_score'] or 0,
+            total_files=total_files,
+            files_with_positive_scores=positive_scores,
+            files_with_negative_scores=negative_scores,
+            files_with_zero_scores=total_files - positive_scores - negative_scores,
+            min_score=min((row['min_score'] for row in group_rows), default=0),
+            max_score=max((row['max_score'] for row in group_rows), default=0),
+            avg_score=score_sum / total_files if total_files else 0,
             median_score=median_score,
-            quality_profiles={row['quality_profile_name']: row['count'] for row in profile_rows},
+            quality_profiles=by_count(profiles),
             most_common_formats=[],  # TODO: Implement format analysis
-            total_size_gb=(stats_row['total_bytes'] or 0) / (1024**3),
-            avg_file_size_gb=((stats_row['total_bytes'] or 0) / (1024**3)) / max(stats_row['total_files'], 1),
-            resolution_distribution={row['resolution']: row['count'] for row in resolution_rows},
-            codec_distribution={row['codec']: row['count'] for row in codec_rows}
+            total_size_gb=total_bytes / (1024**3),
+            avg_file_size_gb=(total_bytes / (1024**3)) / max(total_files, 1),
+            resolution_distribution=by_count(resolutions),
+            codec_distribution=by_count(codecs)
         )
     
-    def _row_to_media_file(self, row: sqlite3.Row) -> MediaFile:
-        """Convert database row to MediaFile object."""
+    def _parse_custom_formats(self, custom_formats_json: Optional[str]) -> List[CustomFormatDetail]:
+        """Parse a custom_formats_json column value into CustomFormatDetail objects."""
         custom_formats = []
-        if row['custom_formats_json']:
+        if custom_formats_json:
             try:
-                formats_data = json.loads(row['custom_formats_json'])
+                formats_data = json.loads(custom_formats_json)
                 custom_formats = [
                     CustomFormatDetail(
                         name=cf['name'],
@@ -724,6 +1014,13 @@ class DatabaseManager:
                 ]
             except (json.JSONDecodeError, KeyError):
                 pass
+        return custom_formats
+    
+    def _row_to_media_file(self, row: sqlite3.Row,
+                           custom_formats: Optional[List[CustomFormatDetail]] = None) -> MediaFile:
+        """Convert database row to MediaFile object, reusing already parsed custom formats if given."""
+        if custom_formats is None:
+            custom_formats = self._parse_custom_formats(row['custom_formats_json'])
         
         return MediaFile(
             file_id=row['file_id'],